@@ -0,0 +1,122 @@
+# %%
+# Times each stage of the table pipeline on synthetic data of several sizes.
+#
+#   python benchmark.py --sizes 10x4 52x7 --out bench.json
+#
+# Sizes are <states>x<years>.  Runs offline against the bundled templates and
+# prints (or writes) one JSON record per size and stage.
+
+import argparse
+import json
+import os
+import tempfile
+from io import BytesIO
+from time import perf_counter
+from typing import List
+
+from common import SnakeTableGenerator
+from crosstab import get_comparisons, get_inclusion
+from datacache import load_frame
+from gen_state_profiles import ProfileLayouts, TableData, get_states
+from schema import apply_schema
+from synthdata import YEARS, write_long_file, write_mapping_results
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Timer:
+
+    def __init__(self, size: dict) -> None:
+        self.size = size
+        self.records: List[dict] = []
+
+    def __call__(self, stage: str, fn, *args, **kwargs):
+        start = perf_counter()
+        result = fn(*args, **kwargs)
+        self.records.append(dict(self.size, stage=stage,
+                                 seconds=round(perf_counter()-start, 6)))
+        return result
+
+
+def bench_profiles(timer: Timer, data_path: str):
+    td = timer('profile_load', TableData, data_path)
+    states = get_states(td)
+    grades = [(stname, gr) for stname, _ in states for gr in (4, 8)]
+
+    timer('profile_filter', lambda: [td.get_state_data(*key) for key in grades])
+    rows = timer('profile_reshape', lambda: {
+        key: (td.get_state_rows(*key), td.get_consortium_rows(*key)) for key in grades})
+
+    layouts = ProfileLayouts(os.path.join(HERE, 'template_state.xlsx'))
+
+    def fill():
+        return [layouts.render(stname, stabbr,
+                               [rows[(stname, gr)][cons] for cons in (0, 1) for gr in (4, 8)])
+                for stname, stabbr in states]
+
+    wbs = timer('profile_fill', fill)
+    timer('profile_save', lambda: [wb.save(BytesIO()) for wb in wbs])
+
+
+def bench_snakecharts(timer: Timer, long_path: str):
+    cwd = os.getcwd()
+    os.chdir(HERE)
+    try:
+        tbl = timer('snake_load', lambda: SnakeTableGenerator(long_path).load())
+        wbs = timer('snake_fill', lambda: [wb for _, wb in tbl.generate_all()])
+        timer('snake_save', lambda: [wb.save(BytesIO()) for wb in wbs])
+    finally:
+        os.chdir(cwd)
+
+
+def bench_crosstab(timer: Timer, data_path: str, years):
+    dta = apply_schema(load_frame(data_path))
+    df = timer('crosstab_inclusion', get_inclusion, dta, years)
+    timer('crosstab_cells', get_comparisons, df, years)
+
+
+def run(sizes, n_consortia: int = 4, seed: int = 0) -> List[dict]:
+    records = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n_states, n_years in sizes:
+            years = YEARS[-n_years:] if n_years <= len(YEARS) else tuple(
+                range(YEARS[-1] - 2*(n_years-1), YEARS[-1]+1, 2))
+            size = {'states': n_states, 'years': n_years, 'consortia': n_consortia}
+            kwargs = dict(n_states=n_states, years=years,
+                          n_consortia=n_consortia, seed=seed)
+
+            data_path = os.path.join(tmpdir, f'results_{n_states}x{n_years}.csv')
+            long_path = os.path.join(tmpdir, f'long_{n_states}x{n_years}.csv')
+            write_mapping_results(data_path, **kwargs)
+            write_long_file(long_path, **kwargs)
+
+            timer = Timer(size)
+            bench_profiles(timer, data_path)
+            bench_snakecharts(timer, long_path)
+            bench_crosstab(timer, data_path, years)
+            records.extend(timer.records)
+
+    return records
+
+
+def parse_size(text: str):
+    n_states, n_years = text.lower().split('x')
+    return int(n_states), int(n_years)
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the table pipeline')
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[(10, 4), (52, 7)],
+                        help='<states>x<years> (the state template holds up to 7 years)')
+    parser.add_argument('--consortia', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    RESULTS = run(args.sizes, args.consortia, args.seed)
+    if args.out:
+        with open(args.out, 'w') as outfile:
+            json.dump(RESULTS, outfile, indent=2)
+    else:
+        print(json.dumps(RESULTS, indent=2))
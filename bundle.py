@@ -0,0 +1,223 @@
+# %%
+# Output sinks for the generator scripts.  Besides one file per table in an
+# output directory, the tables can be streamed into a single zip/tar archive
+# (with a MANIFEST.json of names, sizes and sha256 checksums) or only rendered
+# into memory, e.g. to time generation without any disk I/O.
+#
+# NOTE: Pool workers cannot share an archive, so they write to a BytesSink and
+#       hand the serialized workbook back with their JobResult; the driver then
+#       adds it to the real sink with collect().
+
+import hashlib
+import json
+import os
+import tarfile
+import time
+import traceback
+import zipfile
+from argparse import ArgumentParser
+from io import BytesIO
+from typing import Callable, Dict, Hashable, List, Optional, Union
+
+import openpyxl as xl
+
+from parallel import JobResult, print_result
+from writer import BackgroundWriter, get_writer, save_bytes
+
+MANIFEST_NAME = 'MANIFEST.json'
+TAR_MODES = {'.tar': 'w', '.tar.gz': 'w:gz', '.tgz': 'w:gz'}
+
+
+def workbook_bytes(wb: Union[xl.Workbook, bytes]) -> bytes:
+    if isinstance(wb, bytes):
+        return wb
+    buf = BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+class Sink:
+
+    def write(self, name: str, wb: Union[xl.Workbook, bytes]) -> Optional[bytes]:
+        """Stores `wb` as `name`; whatever is returned goes into the job's result."""
+        raise NotImplementedError
+
+    def for_workers(self) -> 'Sink':
+        """The sink pool workers should write to instead of this one."""
+        return BytesSink()
+
+    def collect(self, name: str, result: JobResult) -> JobResult:
+        """Stores the bytes a worker sent back in `result` (if any)."""
+        if not (result.ok and isinstance(result.value, bytes)):
+            return result
+        try:
+            self.write(name, result.value)
+        except Exception:
+            return result._replace(ok=False, error=traceback.format_exc(), value=None)
+        return result._replace(value=None)
+
+    def poll(self) -> List[JobResult]:
+        """The saves that failed since the last poll(), for sinks that save in the background."""
+        return []
+
+    def close(self) -> List[JobResult]:
+        """Finishes the output; returns the failed saves poll() has not reported."""
+        return []
+
+    def report(self) -> Optional[str]:
+        return None
+
+
+class BytesSink(Sink):
+
+    def write(self, name, wb):
+        return workbook_bytes(wb)
+
+
+class DirectorySink(Sink):
+
+    def __init__(self, outpath: str, writer: BackgroundWriter = None) -> None:
+        self.outpath = outpath
+        self.writer = writer
+
+    def write(self, name, wb):
+        path = os.path.join(self.outpath, name)
+        if self.writer:
+            self.writer.submit(wb, path)
+        elif isinstance(wb, bytes):
+            save_bytes(wb, path)
+        else:
+            wb.save(path)
+
+    def for_workers(self):
+        # Workers write their own files
+        return DirectorySink(self.outpath)
+
+    def poll(self):
+        if not self.writer:
+            return []
+        return [r for r in self.writer.done() if not r.ok]
+
+    def close(self):
+        if not self.writer:
+            return []
+        return [r for r in self.writer.close() if not r.ok]
+
+
+class _ListingSink(Sink):
+
+    def __init__(self) -> None:
+        self.entries: List[dict] = []
+
+    def write(self, name, wb):
+        data = workbook_bytes(wb)
+        self.entries.append({'name': name, 'size': len(data),
+                             'sha256': hashlib.sha256(data).hexdigest()})
+        self._store(name, data)
+
+    def _store(self, name: str, data: bytes):
+        pass
+
+    def manifest(self) -> bytes:
+        return json.dumps(self.entries, indent=1).encode()
+
+    def total_size(self) -> int:
+        return sum(entry['size'] for entry in self.entries)
+
+
+class ArchiveSink(_ListingSink):
+    """Streams every table into one .zip, .tar or .tar.gz file."""
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        ext = next((ext for ext in TAR_MODES if path.lower().endswith(ext)), None)
+        if ext:
+            self._archive = tarfile.open(path, TAR_MODES[ext])
+        else:
+            # xlsx files are already deflated
+            self._archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED)
+
+    def _store(self, name, data):
+        if isinstance(self._archive, zipfile.ZipFile):
+            self._archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime = len(data), time.time()
+            self._archive.addfile(info, BytesIO(data))
+
+    def close(self):
+        self._store(MANIFEST_NAME, self.manifest())
+        self._archive.close()
+        return []
+
+    def report(self):
+        return f'{len(self.entries)} files, {self.total_size():,} bytes in {self.path}'
+
+
+class MemorySink(_ListingSink):
+    """Renders the tables into memory only, keeping the bytes if `keep`."""
+
+    def __init__(self, keep: bool = False) -> None:
+        super().__init__()
+        self.keep = keep
+        self.files: Dict[str, bytes] = dict()
+
+    def _store(self, name, data):
+        if self.keep:
+            self.files[name] = data
+
+    def report(self):
+        return f'{len(self.entries)} files rendered, {self.total_size():,} bytes'
+
+
+# %%
+
+def add_output_arguments(parser: ArgumentParser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--bundle', metavar='FILE',
+                       help='write every table into one archive (.zip, .tar, .tar.gz)')
+    group.add_argument('--render-only', action='store_true',
+                       help='render the tables in memory without writing anything')
+
+
+def get_sink(args, outpath: str) -> Sink:
+    if args.bundle:
+        return ArchiveSink(args.bundle)
+    if args.render_only:
+        return MemorySink()
+    return DirectorySink(outpath, get_writer(args))
+
+
+def _mark_failed(failed: List[JobResult], results: List[JobResult],
+                 filename: Callable[[Hashable], str]) -> List[JobResult]:
+    # The result of the job whose output (`filename(job key)`) failed to save
+    # is marked failed in `results`
+    index = {filename(result.key): i for i, result in enumerate(results)} if failed else {}
+    for result in failed:
+        print_result(result, f'Saving {result.key}')
+        i = index.get(os.path.basename(result.key))
+        if i is None:
+            results.append(result)
+        else:
+            results[i] = results[i]._replace(ok=False, error=result.error)
+    return failed
+
+
+def poll_sink(sink: Sink, results: List[JobResult],
+              filename: Callable[[Hashable], str]) -> List[JobResult]:
+    """
+    Reports the saves that failed since the last call, as they happen, and
+    marks their jobs failed in `results` (see close_sink).
+    """
+    return _mark_failed(sink.poll(), results, filename)
+
+
+def close_sink(sink: Sink, results: List[JobResult],
+               filename: Callable[[Hashable], str]) -> List[JobResult]:
+    """
+    Closes `sink` and reports the failed saves not reported yet.  The result
+    of the job whose output (`filename(job key)`) failed to save is marked
+    failed in `results`.
+    """
+    return _mark_failed(sink.close(), results, filename)
@@ -1,48 +1,142 @@
 
 # %%
-# NOTE: openpyxl throws an error when loading an xlsx with MS Sans Serif in the styles.xml.  Need to delete that entry
+# NOTE: openpyxl throws an error when loading an xlsx with MS Sans Serif in the styles.xml.
+#       Templates are loaded through templates.load_template, which strips that entry.
 
+from __future__ import annotations
+
+import os
 from abc import ABC, abstractmethod
-from copy import copy
+from functools import cached_property
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Tuple
 
-import pandas as pd
+import numpy as np
 import openpyxl as xl
-from openpyxl.styles import Side
-from pandas.core.frame import DataFrame
-
-
-# %%
 
-class TableGenerator(ABC):
+import instrument
+from datacache import load_frame
+from lazy import lazy_import
+from schema import apply_schema
+from style_cache import StyleRegistry
+from templates import load_template
 
-    subjgrade_labels = {'M': 'mathematics', 'R': 'reading'}
+if TYPE_CHECKING:
+    from pandas import DataFrame
 
-    def __init__(self, infile: str) -> None:
-        self._data = pd.read_excel(infile)
+    from partition import PartitionStore
 
-        # Optional data post-processing
-        self._postproc_data(self._data)
+pd = lazy_import('pandas')
+us = lazy_import('us')
 
-        self._data = self._data[self._data['IN_SNAKECHART_FILE'] == 'YES']
-        self._cons_set = {c for c in self._data['Consortia'] if not pd.isna(c)}
 
-        self.state_data = self._data.loc[self._data['state'].isin(
-            self._cons_set) == False]
-        self.cons_data = self._data.loc[self._data['state'].isin(
-            self._cons_set)]
+# %%
 
-        self.states = self.state_data.state.unique()
-        self.consortia = self.cons_data.state.unique()
-        self.years = self._data.year.unique()
+class TableGenerator(ABC):
 
-        for arr in self.states, self.consortia, self.years:
-            arr.sort()
+    subjgrade_labels = {'M': 'mathematics', 'R': 'reading'}
 
-    def _postproc_data(self, input_data: DataFrame):
-        pass
+    # Data views that load() builds up front
+    _views = ('state_data', 'cons_data', 'states', 'consortia', 'years')
+    # Views that depend on every row, not just those of one partition
+    _global_views = ('_cons_set', 'states', 'consortia', 'years')
+
+    def __init__(self, infile: str, verbose: bool = False) -> None:
+        # Nothing is read until a view is first used
+        self._infile = infile
+        self._verbose = verbose
+
+    @classmethod
+    def from_frame(cls, df: DataFrame, verbose: bool = False) -> 'TableGenerator':
+        """A generator over rows that are already loaded, e.g. one partition."""
+        tbl = cls.__new__(cls)
+        tbl._set_data(df, verbose)
+        return tbl
+
+    @classmethod
+    def from_partition(cls, store: PartitionStore, key) -> TableGenerator:
+        """
+        A generator over one partition.  Its global views (consortia, states,
+        years) are those of the whole source, as recorded in the partition index.
+        """
+        tbl = cls.from_frame(store.load(key))
+        for view, value in store.views.get(cls.__name__, {}).items():
+            setattr(tbl, view, set(value) if view == '_cons_set' else value)
+        return tbl
+
+    def global_views(self) -> dict:
+        """The views describing the whole source, for a partition index."""
+        return {view: sorted(getattr(self, view)) for view in self._global_views}
+
+    def _set_data(self, df: DataFrame, verbose: bool = False):
+        self._source = df
+        self._verbose = verbose
+
+    @cached_property
+    @instrument.timed('TableGenerator.load')
+    def _source(self) -> DataFrame:
+        return load_frame(self._infile)
+
+    def load(self) -> TableGenerator:
+        """Builds every view now rather than on first use; returns self."""
+        for view in self._views:
+            getattr(self, view)
+        return self
+
+    def _included(self, df: DataFrame) -> pd.Series:
+        """Mask of the source rows that go into the tables."""
+        return df['IN_SNAKECHART_FILE'] == 'YES'
+
+    # Views of the data, each built the first time it is used
+    @cached_property
+    def _data(self) -> DataFrame:
+        df = self._source
+        return apply_schema(df[self._included(df)], verbose=self._verbose)
+
+    @cached_property
+    def _cons_set(self) -> set:
+        return set(self._data['Consortia'].dropna().unique())
+
+    @cached_property
+    def _is_consortium(self) -> np.ndarray:
+        return self._data['state'].isin(self._cons_set).to_numpy()
+
+    @cached_property
+    def state_data(self) -> DataFrame:
+        return self._data[~self._is_consortium]
+
+    @cached_property
+    def cons_data(self) -> DataFrame:
+        return self._data[self._is_consortium]
+
+    @cached_property
+    def states(self) -> List[str]:
+        return sorted(self.state_data['state'].unique().tolist())
+
+    @cached_property
+    def consortia(self) -> List[str]:
+        return sorted(self.cons_data['state'].unique().tolist())
+
+    @cached_property
+    def years(self) -> List[int]:
+        return sorted(self._data['year'].unique().tolist())
+
+    def for_job(self, job):
+        # Holds every table's rows already (cf. partition.PartitionedContext)
+        return self
+
+    @staticmethod
+    def _format_estimates(df: DataFrame) -> DataFrame:
+        nse_nan = pd.isna(df['nse'])
+        return pd.DataFrame({
+            'nse': df['nse'].astype(object).mask(nse_nan, '\u2013'),
+            'nse_se': df['nse_se'].astype(object).mask(
+                pd.isna(df['nse_se']), '\u2013').mask(nse_nan, '†'),
+            'nse_re': df['nse_re'].astype(object).mask(
+                pd.isna(df['nse_re']), '\u2013').mask(nse_nan, '†')
+        })
 
     @abstractmethod
-    def map_row(self, *args, **kwargs):
+    def format_rows(self, df: DataFrame) -> DataFrame:
         raise NotImplementedError
 
     @abstractmethod
@@ -53,26 +147,23 @@ class TableGenerator(ABC):
 class StateTableGenerator(TableGenerator):
 
     col_offsets = {'R': 3, 'M': 7}
+    template_path = 'source_state.xlsx'
 
-    def map_row(self, nse, nse_se, nse_re, mark, *args, **kwargs):
-        nse_nan = pd.isna(nse)
-        return tuple((
-            '\u2013' if nse_nan else nse,
-            '†' if nse_nan else (
-                '\u2013' if pd.isna(nse_se) else nse_se),
-            '†' if nse_nan else (
-                '\u2013' if pd.isna(nse_re) else nse_re),
-            '!' if mark == '!' else ''
-        ))
+    def format_rows(self, df: DataFrame) -> DataFrame:
+        out = self._format_estimates(df)
+        out['mark'] = (df['mark'] == '!').map({True: '!', False: ''})
+        return out
 
+    @instrument.timed()
     def generate(self, state: str) -> xl.Workbook:
 
-        wb = xl.load_workbook('source_state.xlsx')
+        wb = load_template(self.template_path)
         df = self.state_data[self.state_data['state'] == state]
 
         # Replace state abbr in sheet names
+        abbr = us.states.mapping('name', 'abbr').get(state, state)
         for sheet in wb:
-            sheet.title = sheet.title.replace('_ST_')
+            sheet.title = sheet.title.replace('_ST_', abbr)
 
         for grade in '4', '8':
             ws = wb['G'+grade]
@@ -89,10 +180,9 @@ class StateTableGenerator(TableGenerator):
 
                 j = self.col_offsets[subj]
 
-                rows = data[data['subjgrade'] == subj +
-                            grade].apply(lambda r: self.map_row(**r), axis=1)
+                rows = self.format_rows(data[data['subjgrade'] == subj + grade])
 
-                for i, row_data in enumerate(rows):
+                for i, row_data in enumerate(rows.itertuples(index=False, name=None)):
                     for col in range(len(row_data)):
                         cell = ws.cell(i+9, col+j)
                         cell.value = row_data[col]
@@ -111,38 +201,48 @@ class StateTableGenerator(TableGenerator):
 class SnakeTableGenerator(TableGenerator):
 
     letters = {'R4': 'a', 'M4': 'b', 'R8': 'c', 'M8': 'd'}
-
-    def _postproc_data(self, input_data: DataFrame):
-        # NOTE: Need to update IN_SNAKECHART_FILE variable to ensure blank rows for
-        #       2015 and 2019 for all states except PR and blank rows for PR Reading
-        #       in 2017 and beyond
-        input_data.loc[input_data['year'] ==
-                       2015, 'IN_SNAKECHART_FILE'] = 'YES'
-        input_data.loc[input_data['year'] ==
-                       2019, 'IN_SNAKECHART_FILE'] = 'YES'
-        input_data.loc[input_data['state'] ==
-                       'Puerto Rico', 'IN_SNAKECHART_FILE'] = 'YES'
-        input_data.loc[(input_data['state'] == 'Puerto Rico') & (
-            input_data['year'] < 2017), 'IN_SNAKECHART_FILE'] = 'NO'
-
-    def map_row(self, state, Consortia, nse, nse_se, nse_re, *args, **kwargs):
-        nse_nan = pd.isna(nse)
-        cons = '†' if pd.isna(Consortia) else Consortia
-        return tuple((
-            state,
-            cons,
-            '\u2013' if nse_nan else nse,
-            '†' if nse_nan else (
-                '\u2013' if pd.isna(nse_se) else nse_se),
-            '†' if nse_nan else (
-                '\u2013' if pd.isna(nse_re) else nse_re)
-        ))
-
+    template_path = 'source_snakechart.xlsx'
+
+    _views = TableGenerator._views + ('partitions',)
+
+    def _included(self, df: DataFrame) -> pd.Series:
+        # NOTE: 2015 and 2019 are kept for all states (blank rows), as is Puerto
+        #       Rico, except before 2017 where it has no Reading rows
+        pr = df['state'] == 'Puerto Rico'
+        keep = df['year'].isin((2015, 2019)) | pr | super()._included(df)
+        return keep & ~(pr & (df['year'] < 2017))
+
+    @cached_property
+    def partitions(self) -> Dict[Tuple[int, str], List[List[tuple]]]:
+        """
+        Formatted rows per (year, subjgrade): a block of state rows and then one
+        of consortium rows, each sorted by state.  Built with one pass over the
+        data the first time it is needed.
+        """
+        partitions = dict()
+        for df in self.state_data, self.cons_data:
+            df = df.sort_values('state', kind='mergesort')
+            rows = list(self.format_rows(df).itertuples(index=False, name=None))
+            groups = df.groupby(['year', 'subjgrade'], observed=True).indices
+            for (year, subjgrade), idx in groups.items():
+                partitions.setdefault((int(year), subjgrade), []).append(
+                    [rows[i] for i in idx])
+        return partitions
+
+    def format_rows(self, df: DataFrame) -> DataFrame:
+        out = self._format_estimates(df)
+        out.insert(0, 'state', df['state'])
+        out.insert(1, 'Consortia', df['Consortia'].astype(object).mask(
+            pd.isna(df['Consortia']), '†'))
+        return out
+
+    @instrument.timed()
     def generate(self, year: int, subjgrade: str) -> xl.Workbook:
-        wb = xl.load_workbook('source_snakechart.xlsx')
+        wb = load_template(self.template_path)
         ws = wb['Sheet1']
 
-        styles = [ws.cell(8, i)._style for i in range(2, 7)]
+        registry = StyleRegistry(wb)
+        styles = [registry.of(ws.cell(8, i)) for i in range(2, 7)]
 
         subj = self.subjgrade_labels[subjgrade[0]]
         grade = subjgrade[1]
@@ -160,21 +260,13 @@ class SnakeTableGenerator(TableGenerator):
 
         def apply_border(row_idx):
             for i in range(2, 7):
-                new_bd = copy(ws.cell(row_idx, i).border)
-                new_bd.bottom = Side('thin', '000000')
-                ws.cell(row_idx, i).border = new_bd
+                cell = ws.cell(row_idx, i)
+                cell._style = registry.with_bottom(cell._style)
 
         # Extract row data
         data_rows = list()
         end_rowidx = list()
-        for df in self.state_data, self.cons_data:
-
-            dta = df[(df['year'] == year) & (
-                df['subjgrade'] == subjgrade)].sort_values('state')
-            if not len(dta):
-                continue
-
-            rows = dta.apply(lambda r: self.map_row(**r), axis=1)
+        for rows in self.partitions.get((year, subjgrade), ()):
             data_rows.extend(rows)
             end_rowidx.append(len(data_rows)+7)
 
@@ -183,10 +275,31 @@ class SnakeTableGenerator(TableGenerator):
             for col in range(len(row)):
                 cell = ws.cell(i+8, col+2)
                 cell.value = row[col]
-                cell._style = copy(styles[col])
+                cell._style = styles[col]
 
         # Format bottom borders
         for idx in end_rowidx:
             apply_border(idx)
 
         return wb
+
+    def filename(self, year: int, subjgrade: str) -> str:
+        return f'snake_chart_table_{year}{self.letters[subjgrade]}.xlsx'
+
+    def jobs(self, years: Iterable[int] = None,
+             subjgrades: Iterable[str] = None) -> List[Tuple[int, str]]:
+        """(year, subjgrade) of every table, optionally limited to some years/subjects."""
+        return [(year, sg) for year in (years or self.years)
+                for sg in (subjgrades or self.letters)]
+
+    def generate_all(self, years: Iterable[int] = None, subjgrades: Iterable[str] = None,
+                     outpath: str = None) -> Iterator[Tuple[Tuple[int, str], xl.Workbook]]:
+        """
+        Yields ((year, subjgrade), workbook) for every table, saving each one
+        under `outpath` first if given.
+        """
+        for year, sg in self.jobs(years, subjgrades):
+            wb = self.generate(year, sg)
+            if outpath is not None:
+                wb.save(os.path.join(outpath, self.filename(year, sg)))
+            yield (year, sg), wb
@@ -1,67 +1,106 @@
 # %%
 import json
-from itertools import product
-from typing import Sequence, Union
+from itertools import combinations, product
+from typing import Iterable, Sequence, Union
+import numpy as np
 import pandas as pd
 
+from datacache import load_frame
+from schema import apply_schema
+
 DATAPATH = "U:/ESSIN Task 14/Mapping Report/2019/Standard Method/06_Analysis and Results/Darrick/py_webtables"
 DATAFILE = "StateMappingResults.csv"
 
 # %%
 SUBJGRADES = ('M4', 'R4', 'M8', 'R8')
 
+Key = Union[int, str]
+
+
+def get_inclusion(data: pd.DataFrame, years: Sequence[int]) -> pd.DataFrame:
+    """
+    One row per state with a boolean `{subjgrade}_{year}` column per year and
+    subjgrade, True where the state has a reportable (not excluded) estimate.
+    """
+    df = data[data.is_consortium == False][[
+        'fips', 'state_abbr', 'state']].drop_duplicates()
+
+    included = data[data.year.isin(years) & data.subjgrade.isin(SUBJGRADES) & (
+        data.exclude == False) & pd.notna(data.nse)]
+    flags = pd.crosstab(included.state.astype(str),
+                        included.subjgrade.astype(str) + '_' + included.year.astype(str)) > 0
+
+    cols = [f'{sg}_{year}' for year in years for sg in SUBJGRADES]
+    flags = flags.reindex(columns=cols, fill_value=False)
+    df = df.join(flags, on=df.state.astype(str))
+    return df.fillna({col: False for col in cols}).astype({col: bool for col in cols})
+
+
+def get_masks(data: pd.DataFrame, keys: Sequence[Key]) -> pd.DataFrame:
+    """Inclusion bitmask per state and subjgrade; bit i is set if included for keys[i]."""
+    return pd.DataFrame({
+        sg: sum(data[f'{sg}_{key}'].to_numpy(dtype=np.int64) << i
+                for i, key in enumerate(keys))
+        for sg in SUBJGRADES
+    }, index=data.index)
+
+
+def cell_text(states: Sequence[str]) -> str:
+    if not len(states):
+        return ''
+    return ', '.join(states) + f' ({len(states)} state{"s" if len(states) > 1 else ""})'
+
 
-def get_cells(data: pd.DataFrame, yrs: Sequence[Union[int, str]]):
+def get_cells(data: pd.DataFrame, keys: Sequence[Key]):
+
+    masks = get_masks(data, keys)
 
     cells = dict()
     for sg in SUBJGRADES:
+        # Group the states by bitmask once, keeping data order within each group
+        groups = data['state_abbr'].groupby(masks[sg].to_numpy(), sort=False).agg(list)
+
         out = dict()
-        for included in product((True, False), repeat=2):
+        for included in product((True, False), repeat=len(keys)):
             key = '_'.join(
-                f'{"Included" if included[i] else "Excluded"}{yrs[i]}' for i in range(2))
-
-            states = data[(data[f'{sg}_{yrs[0]}'] == included[0])
-                          & (data[f'{sg}_{yrs[1]}'] == included[1])]['state_abbr']
-
-            out[key] = ', '.join(states) + \
-                f' ({len(states)} state{"s" if len(states) > 1 else ""})' if len(
-                    states) else ''
+                f'{"Included" if inc else "Excluded"}{k}' for inc, k in zip(included, keys))
+            mask = sum(1 << i for i, inc in enumerate(included) if inc)
+            out[key] = cell_text(groups.get(mask, []))
 
         cells[sg] = out
 
     return cells
 
 
-# %%
-dta = pd.read_csv(f'{DATAPATH}/{DATAFILE}')
+def get_comparisons(data: pd.DataFrame, keys: Sequence[Key], sizes: Iterable[int] = None):
+    """Cells for every combination of `sizes` keys (default: all sizes >= 2)."""
+    sizes = sizes or range(2, len(keys)+1)
+    return {combo: get_cells(data, combo)
+            for size in sizes for combo in combinations(keys, size)}
 
-df: pd.DataFrame = dta[(dta.is_consortium == False)][[
-    'fips', 'state_abbr', 'state']].drop_duplicates()
-df['fips'] = df.fips.astype(int)
 
-for year in 2017, 2019:
-    for sg in SUBJGRADES:
-        sgstates = set(dta[(dta.year == year) & (
-            dta.subjgrade == sg) & (dta.exclude == False) & (pd.notna(dta.nse))]['state'])
-        df[f'{sg}_{year}'] = df['state'].isin(sgstates)
+def write_comparisons(data: pd.DataFrame, keys: Sequence[Key], **kwargs):
+    for combo, cells in get_comparisons(data, keys, **kwargs).items():
+        name = '_'.join(str(key) for key in combo)
+        with open(f'StateCrosstab_{name}_Cells.json', 'w') as outfile:
+            outfile.write(json.dumps(cells, sort_keys=True, indent=4))
+
 
 # %%
-YEARS = (2017, 2019)
+if __name__ == '__main__':
+    dta = apply_schema(load_frame(f'{DATAPATH}/{DATAFILE}'), verbose=True)
 
-df.to_csv('StateCrosstab_{0}_{1}_Data.csv'.format(*YEARS))
+    # %%
+    YEARS = (2017, 2019)
 
-with open('StateCrosstab_{0}_{1}_Cells.json'.format(*YEARS), 'w') as outfile:
-    outfile.write(json.dumps(get_cells(df, YEARS),
-                             sort_keys=True, indent=4))
+    df = get_inclusion(dta, YEARS)
+    df.to_csv('StateCrosstab_{0}_{1}_Data.csv'.format(*YEARS))
+    write_comparisons(df, YEARS)
 
-# %%
-# Update - Alt vs Std
-XLSFILE = 'StateCrosstab_Alt_Std.xlsx'
+    # %%
+    # Update - Alt vs Std
+    XLSFILE = 'StateCrosstab_Alt_Std.xlsx'
 
-asdta = pd.read_excel(f'{DATAPATH}/{XLSFILE}')
-# %%
-YEARS = ('ALT', 'STD')
-with open('StateCrosstab_{0}_{1}_Cells.json'.format(*YEARS), 'w') as outfile:
-    outfile.write(json.dumps(get_cells(asdta, YEARS),
-                             sort_keys=True, indent=4))
+    asdta = load_frame(f'{DATAPATH}/{XLSFILE}')
+    write_comparisons(asdta, ('ALT', 'STD'))
 # %%
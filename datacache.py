@@ -0,0 +1,160 @@
+# %%
+# NOTE: Parsing "long file.xlsx" with read_excel costs seconds per run.  Sources
+#       are converted once to a directory of typed NumPy columns next to the
+#       source file and loaded from there while the source's mtime/size match.
+#       Only numeric/bool and string columns are stored: nothing is pickled, so
+#       loading a cache never unpickles a file someone else could have put there.
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from typing import TYPE_CHECKING, Callable, Dict, Tuple
+
+import numpy as np
+
+import instrument
+from lazy import lazy_import
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+pd = lazy_import('pandas')
+
+META_FILE = 'meta.json'
+
+
+def _kind(col: pd.Series) -> str:
+    if col.to_numpy().dtype != object:
+        return 'array'
+    if col.dropna().map(type).eq(str).all():
+        return 'str'
+    return 'object'
+
+
+def save_columns(df: DataFrame, dirpath: str, meta: dict = None):
+    """
+    Writes each column of `df` to `dirpath` as a .npy file.  String columns are
+    stored as fixed-width unicode arrays plus a null mask, so that they (like
+    the numeric columns) can be memory-mapped when loaded.  Raises ValueError
+    for columns of other Python objects, which would need pickling.
+    """
+    kinds = {name: _kind(df[name]) for name in df.columns}
+    if 'object' in kinds.values():
+        raise ValueError('object columns cannot be stored: '
+                         + ', '.join(str(name) for name, kind in kinds.items() if kind == 'object'))
+
+    tmppath = f'{dirpath}.tmp'
+    shutil.rmtree(tmppath, ignore_errors=True)
+    os.makedirs(tmppath)
+
+    columns = []
+    for i, name in enumerate(df.columns):
+        col = df[name]
+        kind = kinds[name]
+        if kind == 'str':
+            np.save(os.path.join(tmppath, f'{i}.npy'),
+                    col.fillna('').to_numpy(dtype=str))
+            np.save(os.path.join(tmppath, f'{i}.mask.npy'),
+                    pd.isna(col).to_numpy())
+        else:
+            np.save(os.path.join(tmppath, f'{i}.npy'), col.to_numpy(), allow_pickle=False)
+        columns.append({'name': name, 'kind': kind})
+
+    with open(os.path.join(tmppath, META_FILE), 'w') as outfile:
+        json.dump(dict(meta or {}, columns=columns), outfile)
+
+    shutil.rmtree(dirpath, ignore_errors=True)
+    os.rename(tmppath, dirpath)
+
+
+def read_meta(dirpath: str) -> dict:
+    with open(os.path.join(dirpath, META_FILE)) as infile:
+        return json.load(infile)
+
+
+def load_arrays(dirpath: str, mmap_mode: str = None,
+                meta: dict = None) -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    The columns written by save_columns as NumPy arrays; needs no pandas.
+    `meta` is the directory's meta.json, if already read.
+    """
+    meta = meta or read_meta(dirpath)
+
+    data = dict()
+    for i, col in enumerate(meta['columns']):
+        path = os.path.join(dirpath, f'{i}.npy')
+        if col['kind'] == 'str':
+            values = np.load(path, mmap_mode=mmap_mode).astype(object)
+            values[np.load(os.path.join(dirpath, f'{i}.mask.npy'))] = np.nan
+        elif col['kind'] != 'array':
+            raise ValueError(f'{dirpath}: column {col["name"]!r} is not stored as an array')
+        else:
+            values = np.load(path, mmap_mode=mmap_mode)
+        data[col['name']] = values
+
+    return data, meta
+
+
+def load_columns(dirpath: str, mmap_mode: str = None,
+                 meta: dict = None) -> Tuple[DataFrame, dict]:
+    data, meta = load_arrays(dirpath, mmap_mode, meta)
+    return pd.DataFrame(data), meta
+
+
+# %%
+
+def get_reader(path: str) -> Callable[..., DataFrame]:
+    if path.lower().endswith(('.xls', '.xlsx', '.xlsm')):
+        return pd.read_excel
+    return pd.read_csv
+
+
+def cache_path(path: str) -> str:
+    head, tail = os.path.split(path)
+    return os.path.join(head, f'.{tail}.cache')
+
+
+def _source_key(path: str, kwargs: dict) -> dict:
+    stat = os.stat(path)
+    return {'source': os.path.abspath(path),
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'kwargs': repr(sorted(kwargs.items()))}
+
+
+def _cacheable(df: DataFrame) -> bool:
+    return (isinstance(df.index, pd.RangeIndex) and df.index.start == 0
+            and all(isinstance(name, str) for name in df.columns))
+
+
+@instrument.timed()
+def load_frame(path: str, reader: Callable[..., DataFrame] = None, use_cache: bool = True,
+               **kwargs) -> DataFrame:
+    """
+    Reads `path` with `reader` (read_excel/read_csv by extension), going
+    through the columnar cache next to the source when it is current.
+    """
+    reader = reader or get_reader(path)
+    if not use_cache:
+        return reader(path, **kwargs)
+
+    key = _source_key(path, kwargs)
+    cache = cache_path(path)
+    try:
+        # The arrays are only read once the cache is known to be current
+        meta = read_meta(cache)
+        if {k: meta.get(k) for k in key} == key:
+            return load_columns(cache, meta=meta)[0]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    df = reader(path, **kwargs)
+    if _cacheable(df):
+        try:
+            save_columns(df, cache, key)
+        except (OSError, ValueError) as err:
+            print(f'Could not write cache for {path}: {err}')
+
+    return df
@@ -0,0 +1,110 @@
+# %%
+# Column derivations used to build StateMappingResults.csv from the long file.
+# Every step works on whole columns, so cost grows with the number of rows and
+# not with per-row Python calls.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Dict, Iterable
+
+import numpy as np
+
+from lazy import lazy_import
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+pd = lazy_import('pandas')
+us = lazy_import('us')
+
+# %% Achievement levels
+NAEP_LABELS = ('Below NAEP Basic',
+               'NAEP Basic',
+               'NAEP Proficient',
+               'NAEP Advanced')
+
+NAEP_CUTS = {
+    'M4': (214, 249, 282),
+    'M8': (262, 299, 333),
+    'R4': (208, 238, 268),
+    'R8': (243, 281, 323)
+}
+
+
+def get_levels(df: DataFrame) -> pd.Series:
+    # Level is the number of cut scores at or below nse + 1.96*nse_se.  A missing
+    # nse_se sorts past every cut, as the upper < cut comparison never held.
+    labels = np.array(NAEP_LABELS, dtype=object)
+    upper = (df['nse'] + 1.96*df['nse_se']).to_numpy()
+    has_nse = pd.notna(df['nse']).to_numpy()
+
+    levels = np.full(len(df), None, dtype=object)
+    for subjgrade, cuts in NAEP_CUTS.items():
+        rows = (df['subjgrade'] == subjgrade).to_numpy() & has_nse
+        levels[rows] = labels[np.searchsorted(cuts, upper[rows], side='right')]
+
+    return pd.Series(levels, index=df.index, name='level')
+
+
+def add_levels(df: DataFrame) -> DataFrame:
+    df['level'] = get_levels(df)
+    return df
+
+
+# %% Consortium rows
+def get_consortium_rows(df: DataFrame, own: Iterable[str] = (),
+                        sources: Dict[tuple, str] = None) -> DataFrame:
+    """
+    Derives one row per (year, subjgrade, consortium) for consortia that have
+    no rows of their own in the long file (e.g. NECAP), whose member states
+    carry the consortium's results.  The first member row of each group is used.
+
+    For a slice of the long file, `own` names the consortia known to have rows
+    of their own elsewhere, which are never derived, and `sources` maps a
+    (year, subjgrade, consortium) to the member an existing row was derived
+    from; such a group is only derived again from that member's row.
+    """
+    keys = ['year', 'subjgrade', 'consortium']
+    rows = df[pd.notna(df['consortium']) & ~df['consortium'].isin(df['state'])
+              & ~df['consortium'].isin(list(own))]
+    if sources:
+        source = [sources.get(key) for key in zip(*(rows[col] for col in keys))]
+        rows = rows[np.array([member in (None, state) for member, state in zip(source, rows['state'])],
+                             dtype=bool)]
+    rows = rows.drop_duplicates(keys)
+
+    return rows.assign(state=rows['consortium'], consortium=np.nan)
+
+
+def add_consortium_rows(df: DataFrame, own: Iterable[str] = (),
+                        sources: Dict[tuple, str] = None) -> DataFrame:
+    return pd.concat([df, get_consortium_rows(df, own, sources)], ignore_index=True)
+
+
+# %% State abbreviations and fips codes
+def add_state_codes(df: DataFrame) -> DataFrame:
+    df['fips'] = df['state'].map(us.states.mapping('name', 'fips'))
+    df['state_abbr'] = df['state'].map(us.states.mapping('name', 'abbr'))
+    return df
+
+
+# %% Indicators
+def add_flags(df: DataFrame, consortia: Iterable[str] = None) -> DataFrame:
+    """
+    `consortia` are the names flagged as is_consortium; by default those in the
+    frame's consortium column.
+    """
+    if consortia is None:
+        consortia = df['consortium'].dropna().unique()
+    df['nse_re_mark'] = df['nse_re'] >= 0.5
+    df['exclude'] = df['IN_SNAKECHART_FILE'] == 'NO'
+    df['is_consortium'] = df['state'].isin(list(consortia))
+    return df
+
+
+def enrich(df: DataFrame, consortia: Iterable[str] = None) -> DataFrame:
+    """Adds the flag, state code and level columns to a long file frame."""
+    df = add_flags(df, consortia)
+    for step in add_state_codes, add_levels:
+        df = step(df)
+    return df
@@ -1,57 +1,139 @@
 # %%
+from __future__ import annotations
+
+import argparse
+import os
 from copy import copy
-from typing import Any, Collection, Sequence
-import pandas as pd
+from functools import partial
+from operator import itemgetter
+from typing import Any, Collection, Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
 import openpyxl as xl
 from openpyxl.styles import Border, Side
 from openpyxl.utils.dataframe import dataframe_to_rows
 
+from bundle import (DirectorySink, Sink, add_output_arguments, close_sink, get_sink,
+                    poll_sink)
+from datacache import load_frame
+import instrument
+from lazy import lazy_import
+from manifest import add_manifest_arguments, code_version, get_manifest, hash_frame, hash_values
+from parallel import add_run_arguments, apply_run_arguments, iter_jobs, print_result, print_summary
+from partition import (PartitionedContext, PartitionStore, add_partition_arguments,
+                       check_partition_root, with_consortia)
+from schema import TRUE_VALUES, apply_schema
+from sheetedit import SheetEditor
+from style_cache import StyleRegistry
+from templates import TEMPLATES, TemplateCache, clone_workbook
+from writer import add_writer_arguments
+
+pd = lazy_import('pandas')
+
 DATAFILE = "StateMappingResults.csv"
 OUTPATH = 'output/state'
 
 # %%
 
 
+RESULT_FIELDS = ['nse', 'nse_se', 'nse_re', 'mark']
+# Display values of a missing result, as _sanitize_rows renders them
+NO_RESULT = ('\u2013', '†', '†', '')
+
+
 class TableData:
 
-    def __init__(self, data_path: str) -> None:
-        self._data = pd.read_csv(data_path)
+    @instrument.timed('TableData.load')
+    def __init__(self, data_path: str, verbose: bool = False) -> None:
+        self._set_data(load_frame(data_path), verbose)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, verbose: bool = False) -> 'TableData':
+        """TableData over rows that are already loaded, e.g. one state's partition."""
+        td = cls.__new__(cls)
+        td._set_data(df, verbose)
+        return td
+
+    @classmethod
+    def from_partition(cls, store: PartitionStore, key) -> TableData:
+        return cls.from_frame(store.load(key))
+
+    def _set_data(self, df: pd.DataFrame, verbose: bool = False):
+        self._data = apply_schema(df, verbose=verbose)
+        self._build_index()
+        self._build_consortium_results()
+
+    def for_job(self, state_info):
+        # Holds every state already (cf. partition.PartitionedContext)
+        return self
+
+    def _build_index(self):
+        # Partition the reportable state rows once, keyed on (state, grade) and
+        # pre-sorted by (year, subjgrade), so lookups only touch their own slice
+        state_rows = self._data[(self._data.year >= 2007) & (
+            self._data.is_consortium == False)]
+        state_rows = state_rows.sort_values(['year', 'subjgrade'], kind='mergesort')
+
+        self._empty = state_rows.iloc[0:0]
+        self._by_state = dict(tuple(state_rows.groupby(
+            'state', sort=False, observed=True)))
+        self._by_state_grade = dict(tuple(state_rows.groupby(
+            [state_rows.state, state_rows.subjgrade.str[-1]], sort=False, observed=True)))
+
+    def _build_consortium_results(self):
+        # Consortium results are the same for every member state, so they are
+        # sanitized once and member lookups only index into them
+        names = self._data.consortium.dropna().unique()
+        cons_rows = self._data.loc[self._data.state.isin(names),
+                                   ['state', 'year', 'subjgrade', 'nse', 'nse_se', 'nse_re']]
+        cons_rows = self._sanitize_rows(cons_rows)
+        keys = zip(cons_rows.state, cons_rows.year, cons_rows.subjgrade)
+        self._consortium_results = dict(zip(
+            keys, cons_rows[RESULT_FIELDS].itertuples(index=False, name=None)))
+
+    def get_state_abbr(self, state: str) -> str:
+        return self._data.loc[self._data.state == state, 'state_abbr'].dropna().iloc[0]
+
+    def get_input_rows(self, state: str):
+        """Every row a state's profile is built from: its own and its consortia's."""
+        return with_consortia(self._data, state, 'consortium')
 
     def get_state_data(self, state: str, grade: int = None):
-        state_rows = self._data[(self._data.state == state) & (
-            self._data.year >= 2007) & (self._data.is_consortium == False)]
-
         if grade:
-            return state_rows[state_rows.subjgrade.str.endswith(f'{grade}')]
+            return self._by_state_grade.get((state, f'{grade}'), self._empty)
 
-        return state_rows
+        return self._by_state.get(state, self._empty)
 
+    @instrument.timed()
     def get_state_rows(self, state: str, grade: int):
-        dta = self.get_state_data(
-            state, grade).sort_values(['year', 'subjgrade'])
+        dta = self.get_state_data(state, grade)
 
         outdf = self._reshape_rows(dta)
         return list(dataframe_to_rows(outdf, header=False, index=False))
 
-    def _reshape_rows(self, df):
-        dta_r = df[df.subjgrade.str.startswith(
-            'R')][['year', 'nse', 'nse_se', 'nse_re']]
-        dta_m = df[df.subjgrade.str.startswith(
-            'M')][['year', 'nse', 'nse_se', 'nse_re']]
-        for sub_dta in dta_r, dta_m:
-            self._sanitize_rows(sub_dta)
+    def _reshape_rows(self, df, sanitize: bool = True):
+        # With sanitize=False, `df` already holds the display values (RESULT_FIELDS)
+        cols = ['year', 'nse', 'nse_se', 'nse_re'] if sanitize else ['year', *RESULT_FIELDS]
+        dta_r = df[df.subjgrade.str.startswith('R')][cols]
+        dta_m = df[df.subjgrade.str.startswith('M')][cols]
+        if sanitize:
+            dta_r, dta_m = self._sanitize_rows(dta_r), self._sanitize_rows(dta_m)
         return pd.merge(dta_r, dta_m, on='year', suffixes=['_R', '_M'])
 
     def _sanitize_rows(self, df):
-        df['mark'] = df.apply(
-            lambda r: '!' if r.nse_re >= 0.5 else '', axis=1)
-        df.loc[pd.isna(df.nse), 'nse'] = '\u2013'
-        df.loc[(df.nse == '\u2013') | (pd.isna(df.nse_se)), 'nse_se'] = '†'
-        df.loc[(df.nse == '\u2013') | (pd.isna(df.nse_re)), 'nse_re'] = '†'
-
+        # Returns a new display frame; the caller's slice is left untouched
+        nse_nan = pd.isna(df.nse)
+        return df.assign(
+            nse=df.nse.astype(object).mask(nse_nan, '\u2013'),
+            nse_se=df.nse_se.astype(object).mask(
+                nse_nan | pd.isna(df.nse_se), '†'),
+            nse_re=df.nse_re.astype(object).mask(
+                nse_nan | pd.isna(df.nse_re), '†'),
+            mark=(df.nse_re >= 0.5).map({True: '!', False: ''}))
+
+    @instrument.timed()
     def get_consortium_rows(self, state: str, grade: int):
-        dta = self.get_state_data(
-            state, grade).sort_values(['year', 'subjgrade'])
+        dta = self.get_state_data(state, grade)
 
         # Need to handle years when state has consortium in one
         # subject but not other
@@ -62,16 +144,104 @@ class TableData:
         if query_dta.empty:
             return []
 
-        dta = pd.merge(query_dta, self._data,
-                       left_on=['year', 'subjgrade', 'consortium'],
-                       right_on=['year', 'subjgrade', 'state'],
-                       how='left')
+        keys = query_dta[['consortium', 'year', 'subjgrade']].itertuples(index=False, name=None)
+        results = pd.DataFrame([self._consortium_results.get(key, NO_RESULT) for key in keys],
+                               columns=RESULT_FIELDS, index=query_dta.index)
         outdf = self._reshape_rows(
-            dta[['year', 'subjgrade', 'nse', 'nse_se', 'nse_re']])
+            pd.concat([query_dta[['year', 'subjgrade']], results], axis=1), sanitize=False)
         outdf = pd.merge(query_dta.loc[pd.notna(query_dta.consortium), [
                          'year', 'consortium']].drop_duplicates(), outdf, on='year')
         return list(dataframe_to_rows(outdf, header=False, index=False))
 
+
+class _Record(NamedTuple):
+    year: int
+    subjgrade: str
+    state: str
+    state_abbr: Any
+    consortium: Any
+    nse: float
+    nse_se: float
+    nse_re: float
+    is_consortium: bool
+
+
+def _has_value(value) -> bool:
+    return isinstance(value, str) or not (value is None or value != value)
+
+
+def _sanitize_record(rec: _Record) -> tuple:
+    # Same display values as TableData._sanitize_rows
+    nse_nan = not _has_value(rec.nse)
+    return ('\u2013' if nse_nan else rec.nse,
+            '†' if nse_nan or not _has_value(rec.nse_se) else rec.nse_se,
+            '†' if nse_nan or not _has_value(rec.nse_re) else rec.nse_re,
+            '!' if _has_value(rec.nse_re) and rec.nse_re >= 0.5 else '')
+
+
+def _reshape_records(rows: Sequence[tuple]) -> List[list]:
+    # (year, subjgrade, *RESULT_FIELDS) rows -> [year, *R fields, *M fields],
+    # joined on year in the order of the reading rows like TableData._reshape_rows
+    reading = [row for row in rows if row[1].startswith('R')]
+    math = [row for row in rows if row[1].startswith('M')]
+    return [[r[0], *r[2:], *m[2:]] for r in reading for m in math if m[0] == r[0]]
+
+
+class StateRecords:
+    """
+    The TableData lookups for a single state's partition, worked out on its
+    NumPy columns (partition.PartitionStore.load_arrays) without building any
+    DataFrame, so that a one-off run for a state never loads pandas.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray]) -> None:
+        is_consortium = columns['is_consortium']
+        if is_consortium.dtype != bool:
+            is_consortium = np.isin(is_consortium, TRUE_VALUES)
+        records = [_Record(*values) for values in zip(
+            *(columns[name].tolist() for name in _Record._fields[:-1]), is_consortium.tolist())]
+
+        # TableData's index order: stable by (year, subjgrade)
+        self._records = sorted(records, key=lambda rec: (rec.year, rec.subjgrade))
+
+        names = {rec.consortium for rec in records if _has_value(rec.consortium)}
+        self._consortium_results = {
+            (rec.state, rec.year, rec.subjgrade): _sanitize_record(rec)
+            for rec in records if rec.state in names}
+
+    @classmethod
+    def from_partition(cls, store: PartitionStore, key) -> StateRecords:
+        return cls(store.load_arrays(key))
+
+    def for_job(self, state_info):
+        return self
+
+    def get_state_abbr(self, state: str) -> str:
+        return next(rec.state_abbr for rec in self._records if rec.state == state)
+
+    def get_state_data(self, state: str, grade: int) -> List[_Record]:
+        return [rec for rec in self._records
+                if rec.state == state and rec.year >= 2007 and not rec.is_consortium
+                and rec.subjgrade.endswith(f'{grade}')]
+
+    def get_state_rows(self, state: str, grade: int) -> List[list]:
+        return _reshape_records([(rec.year, rec.subjgrade, *_sanitize_record(rec))
+                                 for rec in self.get_state_data(state, grade)])
+
+    def get_consortium_rows(self, state: str, grade: int) -> List[list]:
+        dta = self.get_state_data(state, grade)
+        cons_yrs = {rec.year for rec in dta if _has_value(rec.consortium)}
+        query = [rec for rec in dta if rec.year in cons_yrs]
+
+        rows = _reshape_records([
+            (rec.year, rec.subjgrade,
+             *self._consortium_results.get((rec.consortium, rec.year, rec.subjgrade), NO_RESULT))
+            for rec in query])
+        pairs = dict.fromkeys((rec.year, rec.consortium) for rec in query if _has_value(rec.consortium))
+        return [[year, consortium, *row[1:]] for year, consortium in pairs
+                for row in rows if row[0] == year]
+
+
 # %%
 
 
@@ -94,38 +264,38 @@ def get_consortium_text(consortia: Collection[str]):
     return ' '.join(CONS_NOTES.get(consortium, '') for consortium in consortia)
 
 
-def remove_rows(ws, start, num=1):
+@instrument.timed()
+def remove_rows(ws, start, num=1, editor: SheetEditor = None):
+    editor = editor or SheetEditor(ws)
     ws.delete_rows(start, num)
     for i in range(start, start+num+1):
-        merged = [
-            rng for rng in ws.merged_cells.ranges if rng.coord.startswith(f'A{i}')]
-        for rng in merged:
-            ws.merged_cells.remove(rng.coord)
-
+        editor.drop_merged(i)
         ws.row_dimensions[i].height = None
 
 
 def get_note_row(ws, rownum: int):
-    row = list(ws.rows)[rownum-1]
-    cell = row[0]
+    cell = ws.cell(rownum, 1)
     return {'value': cell.value,
-            'height': ws.row_dimensions[cell.row].height,
+            'height': ws.row_dimensions[rownum].height,
             'font': copy(cell.font),
             'alignment': copy(cell.alignment)}
 
 
-def write_notes(ws, notes, start_row=14):
-    end_col = 'I' if ws.max_column == 9 else 'J'
+@instrument.timed()
+def write_notes(ws, notes, start_row=14, editor: SheetEditor = None,
+                styles: StyleRegistry = None):
+    editor = editor or SheetEditor(ws)
+    styles = styles or StyleRegistry(ws.parent)
+    end_col = 9 if ws.max_column == 9 else 10
     for i, note in enumerate(notes):
         rownum = start_row+i
 
-        tgt_cell = ws[f'A{rownum}']
+        tgt_cell = ws.cell(rownum, 1)
         tgt_cell.value = note['value']
-        tgt_cell.font = note['font']
-        tgt_cell.alignment = note['alignment']
-        tgt_cell.border = copy(NO_BORDER)
+        tgt_cell._style = styles.derive(tgt_cell._style, font=note['font'],
+                                        alignment=note['alignment'], border=NO_BORDER)
         ws.row_dimensions[rownum].height = note['height']
-        ws.merge_cells(f'A{rownum}:{end_col}{rownum}')
+        editor.merge_row(rownum, 1, end_col)
 
 
 # STATE TABLE
@@ -176,10 +346,21 @@ def edit_notes_PR(note_rows: Sequence):
     note_rows[-1]['height'] -= 13
 
 
-def write_table(ws, state: str, state_abbr: str, row_data: Sequence[Sequence[Any]]):
+class TablePlan(NamedTuple):
+    sheet_title: str
+    title: str
+    row_data: Sequence[Sequence[Any]]
+    notes: List[dict]
+
+    @property
+    def layout(self):
+        # Everything the structural edits depend on
+        return (len(self.row_data),
+                tuple((note['index'], note['height']) for note in self.notes))
 
-    # Set sheet name
-    ws.title = ws.title.replace('_ST_', state_abbr)
+
+def plan_table(ws, state: str, state_abbr: str, row_data: Sequence[Sequence[Any]]) -> TablePlan:
+    """Works out the text and notes of a table from its (unmodified) template sheet."""
 
     # Set table title
     title_text = ws['A4'].value.replace('[STATE]', state)
@@ -188,21 +369,13 @@ def write_table(ws, state: str, state_abbr: str, row_data: Sequence[Sequence[Any
     if '[YEARS]' in title_text:
         title_text = title_text.replace('[YEARS]', year_title_text(years))
 
-    ws['A4'].value = title_text
-
-    # Write data
-    for i, rowdta in enumerate(row_data):
-        row = list(ws.rows)[i+6]
-        for j, dta in enumerate(rowdta):
-            row[j].value = dta
-
     # Get notes
-    note_rows = [get_note_row(ws, i+14) for i in range(5)]
+    note_rows = [dict(get_note_row(ws, i+14), index=i) for i in range(5)]
     if state_abbr == 'PR':
         edit_notes_PR(note_rows)
 
     # Add consortium note text
-    if '[CONSORTIUM_NOTES]' in note_rows[3]['value'] and (consortia := {r[1] for r in row_data}):
+    if '[CONSORTIUM_NOTES]' in note_rows[3]['value'] and (consortia := dict.fromkeys(r[1] for r in row_data)):
         note_rows[3]['value'] = note_rows[3]['value'].replace(
             '[CONSORTIUM_NOTES]',
             get_consortium_text(consortia)
@@ -226,36 +399,195 @@ def write_table(ws, state: str, state_abbr: str, row_data: Sequence[Sequence[Any
              True]
     note_rows = [note for flag, note in zip(flags, note_rows) if flag]
 
+    return TablePlan(ws.title.replace('_ST_', state_abbr), title_text, row_data, note_rows)
+
+
+def apply_layout(ws, plan: TablePlan, editor: SheetEditor = None):
+    """Structural edits: shrink the table, move the notes up and drop the spare rows."""
+    editor = editor or SheetEditor(ws)
+    n_rows = len(plan.row_data)
+
     # Shrink table
     tbl = list(ws.tables.values())[0]
-    tbl.ref = tbl.ref.replace('13', f'{6 + len(row_data)}')
-    write_notes(ws, note_rows, start_row=7+len(row_data))
+    tbl.ref = tbl.ref.replace('13', f'{6 + n_rows}')
+    write_notes(ws, plan.notes, start_row=7+n_rows, editor=editor)
+
+    len_data = 7+n_rows+len(plan.notes)
+    remove_rows(ws, len_data, ws.max_row-len_data, editor=editor)
+
+
+def fill_table(ws, plan: TablePlan, editor: SheetEditor = None):
+    """Writes the per-state values into a sheet laid out for `plan`."""
+    editor = editor or SheetEditor(ws)
+
+    ws.title = plan.sheet_title
+    ws['A4'].value = plan.title
+
+    for i, rowdta in enumerate(plan.row_data):
+        editor.write_row(i+7, rowdta)
+
+    start_row = 7+len(plan.row_data)
+    for i, note in enumerate(plan.notes):
+        ws.cell(start_row+i, 1).value = note['value']
 
-    len_data = 7+len(row_data)+len(note_rows)
-    remove_rows(ws, len_data, ws.max_row-len_data)
 
+@instrument.timed()
+def write_table(ws, state: str, state_abbr: str, row_data: Sequence[Sequence[Any]]):
+    plan = plan_table(ws, state, state_abbr, row_data)
+    editor = SheetEditor(ws)
+    fill_table(ws, plan, editor)
+    apply_layout(ws, plan, editor)
+
+
+class ProfileLayouts:
+    """
+    Compiled variants of the state profile template.  The structural edits of a
+    workbook only depend on each sheet's TablePlan.layout (row count and which
+    notes, at what heights), so each variant is built once and every state
+    with that layout gets a copy with its values filled in.
+    """
+
+    def __init__(self, template_path: str = 'template_state.xlsx', templates: TemplateCache = TEMPLATES) -> None:
+        self.template_path = template_path
+        self._templates = templates
+        self._compiled = dict()
+
+    def _compile(self, plans: Sequence[Optional[TablePlan]]) -> xl.Workbook:
+        wb = self._templates.get(self.template_path)
+        for ws, plan in zip(list(wb), plans):
+            if plan is None:
+                del wb[ws.title]
+            else:
+                apply_layout(ws, plan)
+        return wb
+
+    def digest(self) -> str:
+        return self._templates.digest(self.template_path)
+
+    @instrument.timed()
+    def render(self, state: str, state_abbr: str,
+               tables: Sequence[Sequence[Sequence[Any]]]) -> xl.Workbook:
+        """`tables` holds the row data per template sheet (empty to drop the sheet)."""
+        master = self._templates.master(self.template_path)
+        plans = [plan_table(ws, state, state_abbr, rows) if rows else None
+                 for ws, rows in zip(master, tables)]
+
+        key = (self.digest(),
+               tuple(plan and plan.layout for plan in plans))
+        if key not in self._compiled:
+            self._compiled[key] = self._compile(plans)
+
+        wb = clone_workbook(self._compiled[key])
+        for ws, plan in zip(wb.worksheets, [plan for plan in plans if plan]):
+            fill_table(ws, plan)
+        return wb
+
+
+LAYOUTS = ProfileLayouts()
 
 # %%
-td = TableData(DATAFILE)
 
-STATES = td._data.loc[td._data.is_consortium ==
-                      False, ['state', 'state_abbr']].drop_duplicates()
+
+def get_state_tables(td: TableData, state: str):
+    return [td.get_state_rows(state, 4), td.get_state_rows(state, 8),
+            td.get_consortium_rows(state, 4), td.get_consortium_rows(state, 8)]
+
+
+def write_state_profile(td: TableData, state: str, state_abbr: str, outpath: str = OUTPATH,
+                        sink: Sink = None):
+    name = f'{state}.xlsx'
+    with instrument.output(name):
+        wb = LAYOUTS.render(state, state_abbr, get_state_tables(td, state))
+
+        with instrument.stage('save'):
+            return (sink or DirectorySink(outpath)).write(name, wb)
+
+
+def _write_state_profile(td: TableData, state_info, sink: Sink = None):
+    td = td.for_job(state_info)
+    state, state_abbr = state_info
+    return write_state_profile(td, state, state_abbr or td.get_state_abbr(state), sink=sink)
+
+
+def profile_digest(td: TableData, state: str, state_abbr: str) -> str:
+    return hash_values(state, state_abbr, hash_frame(td.get_input_rows(state)),
+                       LAYOUTS.digest(), code_version(TableData, SheetEditor, StyleRegistry, clone_workbook,
+                                                      apply_schema, load_frame))
+
+
+def get_states(td: TableData):
+    states = td._data.loc[td._data.is_consortium ==
+                          False, ['state', 'state_abbr']].drop_duplicates()
+    return list(states.itertuples(index=False, name=None))
+
+
 # %%
-for _, state_row in STATES.iterrows():
-    stname = state_row['state']
-    stabbr = state_row['state_abbr']
-    print(f'State: {stname}')
-    WB = xl.load_workbook('template_state.xlsx')
-    SHEETS = list(WB)
-    for i, sheet in enumerate(SHEETS):
-        gr = 8 if i % 2 else 4
-        rowfn = td.get_state_rows if i < 2 else td.get_consortium_rows
-        rows = rowfn(stname, gr)
-        if not rows:
-            del WB[sheet.title]
-        else:
-            write_table(sheet, stname, stabbr, rows)
-
-    WB.save(f'output/state/{stname}.xlsx')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate state profile workbooks')
+    add_run_arguments(parser)
+    add_manifest_arguments(parser)
+    add_writer_arguments(parser)
+    add_output_arguments(parser)
+    add_partition_arguments(parser)
+    parser.add_argument('--state', nargs='+', metavar='NAME',
+                        help='only these states (with --partition-root, without loading pandas)')
+    args = parser.parse_args()
+    apply_run_arguments(args)
+    check_partition_root(parser, args)
+
+    if args.state and args.partition_root:
+        # Quick one-off path: each state is filled from its partition's NumPy
+        # columns; no full data load, no DataFrames and no incremental manifest
+        factory, factory_args = PartitionedContext, (args.partition_root, StateRecords, itemgetter(0))
+        context = factory(*factory_args)
+        known = {key[0] for key in context.store.keys()}
+        states = [(state, None) for state in args.state]
+    else:
+        td = TableData(DATAFILE, verbose=True)
+        factory, factory_args, context = TableData, (DATAFILE,), td
+        if args.partition_root:
+            # Jobs open their state's partition; the full data only lists the states
+            factory, factory_args = PartitionedContext, (args.partition_root, TableData, itemgetter(0))
+            context = factory(*factory_args)
+        all_states = get_states(td)
+        known = {st[0] for st in all_states}
+        states = [st for st in all_states if not args.state or st[0] in args.state]
+    if unknown := [state for state in args.state or () if state not in known]:
+        parser.error(f'unknown state{"s" * (len(unknown) > 1)}: {", ".join(unknown)}')
+
+    sink = get_sink(args, OUTPATH)
+    manifest = (get_manifest(args, OUTPATH) if isinstance(sink, DirectorySink)
+                and not (args.state and args.partition_root) else None)
+    if manifest:
+        states = [st for st in states
+                  if manifest.needs_build(f'{st[0]}.xlsx', profile_digest(td, *st))]
+
+    def filename(key) -> str:
+        return f'{key[0]}.xlsx'
+
+    results = []
+    try:
+        task = partial(_write_state_profile, sink=sink if args.jobs == 1 else sink.for_workers())
+        for result in iter_jobs(task, states, factory, factory_args, jobs=args.jobs, context=context):
+            result = sink.collect(filename(result.key), result)
+            print_result(result, f'State: {result.key[0]}')
+            results.append(result)
+            if manifest and result.ok:
+                manifest.built(filename(result.key))
+            # Saves in the background fail after their job has succeeded
+            for failed in poll_sink(sink, results, filename):
+                if manifest:
+                    manifest.discard(os.path.basename(failed.key))
+    finally:
+        for failed in close_sink(sink, results, filename):
+            if manifest:
+                manifest.discard(os.path.basename(failed.key))
+        if manifest:
+            manifest.save()
+    print_summary(results)
+    for report in (manifest and manifest.report(), sink.report()):
+        if report:
+            print(report)
 
 # %%
@@ -1,5 +1,20 @@
 # %%
+import argparse
+import os
+from functools import partial
+
+from bundle import (DirectorySink, Sink, add_output_arguments, close_sink, get_sink,
+                    poll_sink)
 from common import SnakeTableGenerator
+from datacache import load_frame
+import instrument
+from manifest import add_manifest_arguments, code_version, get_manifest, hash_values
+from parallel import add_run_arguments, apply_run_arguments, iter_jobs, print_result, print_summary
+from partition import PartitionedContext, add_partition_arguments, check_partition_root
+from schema import apply_schema
+from style_cache import StyleRegistry
+from templates import TEMPLATES, clone_workbook
+from writer import add_writer_arguments
 
 # %%
 
@@ -9,13 +24,79 @@ OUTPATH = 'output/snakechart'
 
 
 # %%
-TBL = SnakeTableGenerator(f'{DATAPATH}/{DATAFILE}')
+
+
+def save_snakechart(tbl: SnakeTableGenerator, job, sink: Sink = None):
+    year, sg = job
+    tbl = tbl.for_job(job)
+    name = tbl.filename(year, sg)
+    with instrument.output(name):
+        wb = tbl.generate(year, sg)
+        with instrument.stage('save'):
+            return (sink or DirectorySink(OUTPATH)).write(name, wb)
+
+
+def snakechart_digest(tbl: SnakeTableGenerator, job) -> str:
+    return hash_values(job, tbl.partitions.get(job, []), TEMPLATES.digest(tbl.template_path),
+                       code_version(SnakeTableGenerator, StyleRegistry, clone_workbook,
+                                    apply_schema, load_frame))
+
 
 # %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate snake chart tables')
+    parser.add_argument('--years', nargs='+', type=int,
+                        help='only these assessment years (default: all)')
+    parser.add_argument('--subjgrades', nargs='+', choices=list(SnakeTableGenerator.letters),
+                        help='only these subject/grades (default: all)')
+    add_run_arguments(parser)
+    add_manifest_arguments(parser)
+    add_writer_arguments(parser)
+    add_output_arguments(parser)
+    add_partition_arguments(parser)
+    args = parser.parse_args()
+    apply_run_arguments(args)
+    check_partition_root(parser, args)
+
+    INFILE = f'{DATAPATH}/{DATAFILE}'
+    TBL = SnakeTableGenerator(INFILE, verbose=True)
+    factory, factory_args, context = SnakeTableGenerator, (INFILE,), TBL
+    if args.partition_root:
+        factory, factory_args = PartitionedContext, (args.partition_root, SnakeTableGenerator)
+        context = factory(*factory_args)
+    JOBS = TBL.jobs(args.years, args.subjgrades)
+    sink = get_sink(args, OUTPATH)
+    manifest = get_manifest(args, OUTPATH) if isinstance(sink, DirectorySink) else None
+    if manifest:
+        JOBS = [job for job in JOBS
+                if manifest.needs_build(TBL.filename(*job), snakechart_digest(TBL, job))]
+
+    def filename(key) -> str:
+        return TBL.filename(*key)
 
-for year in set(TBL.state_data['year']):
-    for sg in 'R4', 'M4', 'R8', 'M8':
-        TBL.generate(year, sg).save(
-            f"{OUTPATH}/snake_chart_table_{year}{TBL.letters[sg]}.xlsx")
+    results = []
+    try:
+        task = partial(save_snakechart, sink=sink if args.jobs == 1 else sink.for_workers())
+        for result in iter_jobs(task, JOBS, factory, factory_args,
+                                jobs=args.jobs, context=context):
+            result = sink.collect(filename(result.key), result)
+            print_result(result, 'Table {0}{1}'.format(*result.key))
+            results.append(result)
+            if manifest and result.ok:
+                manifest.built(filename(result.key))
+            # Saves in the background fail after their job has succeeded
+            for failed in poll_sink(sink, results, filename):
+                if manifest:
+                    manifest.discard(os.path.basename(failed.key))
+    finally:
+        for failed in close_sink(sink, results, filename):
+            if manifest:
+                manifest.discard(os.path.basename(failed.key))
+        if manifest:
+            manifest.save()
+    print_summary(results)
+    for report in (manifest and manifest.report(), sink.report()):
+        if report:
+            print(report)
 
 # %%
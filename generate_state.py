@@ -1,5 +1,19 @@
 # %%
+import argparse
+import os
+from functools import partial
+
+from bundle import (DirectorySink, Sink, add_output_arguments, close_sink, get_sink,
+                    poll_sink)
 from common import StateTableGenerator
+from datacache import load_frame
+import instrument
+from manifest import add_manifest_arguments, code_version, get_manifest, hash_frame, hash_values
+from parallel import add_run_arguments, apply_run_arguments, iter_jobs, print_result, print_summary
+from partition import PartitionedContext, add_partition_arguments, check_partition_root
+from schema import apply_schema
+from templates import TEMPLATES, clone_workbook
+from writer import add_writer_arguments
 # %%
 
 
@@ -8,10 +22,73 @@ DATAFILE = "long file.xlsx"
 OUTPATH = 'output/state'
 
 # %%
-TBL = StateTableGenerator(f'{DATAPATH}/{DATAFILE}')
+
+
+def save_state(tbl: StateTableGenerator, state: str, sink: Sink = None):
+    with instrument.output(f'{state}.xlsx'):
+        wb = tbl.for_job(state).generate(state)
+        with instrument.stage('save'):
+            return (sink or DirectorySink(OUTPATH)).write(f'{state}.xlsx', wb)
+
+
+def state_digest(tbl: StateTableGenerator, state: str) -> str:
+    # The years are listed in every state's table
+    return hash_values(state, tbl.years, hash_frame(tbl.state_data[tbl.state_data['state'] == state]),
+                       TEMPLATES.digest(tbl.template_path),
+                       code_version(StateTableGenerator, clone_workbook, apply_schema, load_frame))
+
+
 # %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate state tables')
+    add_run_arguments(parser)
+    add_manifest_arguments(parser)
+    add_writer_arguments(parser)
+    add_output_arguments(parser)
+    add_partition_arguments(parser)
+    args = parser.parse_args()
+    apply_run_arguments(args)
+    check_partition_root(parser, args)
+
+    INFILE = f'{DATAPATH}/{DATAFILE}'
+    TBL = StateTableGenerator(INFILE, verbose=True)
+    factory, factory_args, context = StateTableGenerator, (INFILE,), TBL
+    if args.partition_root:
+        factory, factory_args = PartitionedContext, (args.partition_root, StateTableGenerator)
+        context = factory(*factory_args)
+    STATES = TBL.states
+    sink = get_sink(args, OUTPATH)
+    manifest = get_manifest(args, OUTPATH) if isinstance(sink, DirectorySink) else None
+    if manifest:
+        STATES = [state for state in STATES
+                  if manifest.needs_build(f'{state}.xlsx', state_digest(TBL, state))]
+
+    def filename(key) -> str:
+        return f'{key}.xlsx'
 
-for state in TBL.states:
-    TBL.generate(state).save(f'{OUTPATH}/{state}.xlsx')
+    results = []
+    try:
+        task = partial(save_state, sink=sink if args.jobs == 1 else sink.for_workers())
+        for result in iter_jobs(task, STATES, factory, factory_args,
+                                jobs=args.jobs, context=context):
+            result = sink.collect(filename(result.key), result)
+            print_result(result, f'State: {result.key}')
+            results.append(result)
+            if manifest and result.ok:
+                manifest.built(filename(result.key))
+            # Saves in the background fail after their job has succeeded
+            for failed in poll_sink(sink, results, filename):
+                if manifest:
+                    manifest.discard(os.path.basename(failed.key))
+    finally:
+        for failed in close_sink(sink, results, filename):
+            if manifest:
+                manifest.discard(os.path.basename(failed.key))
+        if manifest:
+            manifest.save()
+    print_summary(results)
+    for report in (manifest and manifest.report(), sink.report()):
+        if report:
+            print(report)
 
 # %%
@@ -0,0 +1,183 @@
+# %%
+# Per-stage wall time, call counts and tracemalloc peaks for the table scripts.
+#
+# Switched on with NAEP_PROFILE=<file.json|file.csv> (or a script's --profile
+# option).  While off, stage() hands back a shared no-op context manager and
+# timed() wrappers only test a module flag before calling through.
+
+import atexit
+import csv
+import json
+import multiprocessing
+import os
+import tracemalloc
+from functools import wraps
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+ENV_VAR = 'NAEP_PROFILE'
+FIELDS = ['output', 'stage', 'calls', 'seconds', 'peak_kib']
+
+_enabled = False
+_owner = None
+_records: Dict[Tuple[str, str], List[float]] = dict()
+_stack: List['_Stage'] = []
+_output = ''
+
+
+def _traced_peak() -> int:
+    return tracemalloc.get_traced_memory()[1]
+
+
+def _reset_peak():
+    # tracemalloc.reset_peak is only available on Python 3.9+
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+def _add(output: str, name: str, calls: int, seconds: float, peak: int):
+    rec = _records.setdefault((output, name), [0, 0.0, 0])
+    rec[0] += calls
+    rec[1] += seconds
+    rec[2] = max(rec[2], peak)
+
+
+class _Stage:
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.peak = 0
+
+    def __enter__(self):
+        if _stack:
+            parent = _stack[-1]
+            parent.peak = max(parent.peak, _traced_peak())
+        _reset_peak()
+        _stack.append(self)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = perf_counter() - self.start
+        _stack.pop()
+        self.peak = max(self.peak, _traced_peak())
+        if _stack:
+            _stack[-1].peak = max(_stack[-1].peak, self.peak)
+        _add(_output, self.name, 1, seconds, self.peak)
+        return False
+
+
+class _NullStage:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullStage()
+
+
+class _Output(_Stage):
+
+    def __init__(self, name: str) -> None:
+        super().__init__('total')
+        self.output = name
+
+    def __enter__(self):
+        global _output
+        self.previous, _output = _output, self.output
+        return super().__enter__()
+
+    def __exit__(self, *exc):
+        global _output
+        super().__exit__(*exc)
+        _output = self.previous
+        return False
+
+
+def stage(name: str):
+    return _Stage(name) if _enabled else _NULL
+
+
+def output(name: str):
+    """Attributes the stages run inside the block to output file `name`."""
+    return _Output(name) if _enabled else _NULL
+
+
+def timed(name: str = None):
+    def decorator(fn):
+        label = name or fn.__qualname__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Stage(label):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# %%
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable(path: str = None):
+    """Starts recording; with `path`, the records are dumped there at exit."""
+    global _enabled, _owner
+    _enabled = True
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    if path and _owner is None:
+        # Worker processes inherit the variable and switch on at import; their
+        # records are sent back with each job (see parallel.py) and only the
+        # process that asked for the dump writes it
+        os.environ[ENV_VAR] = path
+        _owner = os.getpid()
+        atexit.register(lambda: os.getpid() == _owner and dump(path))
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def collect() -> List[list]:
+    """Removes and returns the raw records, e.g. to ship them from a worker."""
+    records = [[output, name, *rec] for (output, name), rec in _records.items()]
+    _records.clear()
+    return records
+
+
+def merge(records: List[list]):
+    for output, name, calls, seconds, peak in records or ():
+        _add(output, name, calls, seconds, peak)
+
+
+def summary() -> List[dict]:
+    return [dict(zip(FIELDS, (output, name, calls, round(seconds, 6), round(peak/1024, 1))))
+            for (output, name), (calls, seconds, peak) in sorted(_records.items())]
+
+
+def dump(path: str):
+    rows = summary()
+    with open(path, 'w', newline='') as outfile:
+        if path.lower().endswith('.csv'):
+            writer = csv.DictWriter(outfile, FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump(rows, outfile, indent=2)
+
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR] if multiprocessing.parent_process() is None else None)
@@ -0,0 +1,25 @@
+# %%
+# Deferred imports for the heavy dependencies (pandas, us, ...).  The generator
+# modules bind them at import time but only pay for loading them once an
+# attribute is first used, so e.g. a one-state run from a partition never loads
+# pandas at all.
+
+import importlib.util
+import sys
+from types import ModuleType
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Module `name`, executed on first attribute access (importlib.util.LazyLoader)."""
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
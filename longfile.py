@@ -1,90 +1,320 @@
 # %%
+# Builds StateMappingResults.csv from the long file.
+#
+#   python longfile.py                       # full rebuild from DATAPATH/DATAFILE
+#   python longfile.py "2021 rows.xlsx" --delta
+#
+# With --delta the source only holds new or corrected long file rows (e.g. the
+# next assessment year).  Only those rows are enriched; they replace the rows
+# with the same (year, subjgrade, state) and are merged in sort order into the
+# existing csv, whose other lines are copied over verbatim.
+#
+# NOTE: Consortium rows are derived from the delta as in a full build, except
+#       that consortia with rows of their own in the existing csv (e.g. SBAC)
+#       are never derived, and an existing derived row (e.g. NECAP) is only
+#       replaced when the delta holds the member row it was copied from.
+#
+#   python longfile.py --self-check         # ingest vs full rebuild, synthetic data
+
+import argparse
 import csv
-import pandas as pd
-import us
-from numpy import nan
+import heapq
+import os
+import sys
+import tempfile
+from bisect import bisect_left, bisect_right
+from itertools import groupby
+from operator import itemgetter
+from time import perf_counter
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+from pandas.core.frame import DataFrame
+
+from datacache import get_reader
+from enrich import add_consortium_rows, enrich
 
 DATAPATH = "U:/ESSIN Task 14/Mapping Report/2019/Standard Method/02_Mapping Tool Design/Data Source/SourceTable_States/SAS/Updated data/Long Files/Updated 0413"
 DATAFILE = "long file.xlsx"
-# %%
-dta = pd.read_excel(f'{DATAPATH}/{DATAFILE}')
-years = set(dta.year)
+RESULTS_FILE = 'StateMappingResults.csv'
+
+# %% Exported columns, in sort order
+COLUMNS = ['year',
+           'subjgrade',
+           'fips',
+           'state_abbr',
+           'state',
+           'consortium',
+           'nse',
+           'nse_se',
+           'nse_re',
+           'level',
+           'nse_re_mark',
+           'exclude',
+           'is_consortium']
+
+ROW_KEY = ('year', 'subjgrade', 'state')
+
+
+def _parse_bool(value: str) -> bool:
+    return value == 'True'
+
+
+# Reads the values of a csv line back for sorting; empty fields are missing
+_PARSERS = {'year': int, 'nse': float, 'nse_se': float, 'nse_re': float,
+            'nse_re_mark': _parse_bool, 'exclude': _parse_bool, 'is_consortium': _parse_bool}
+
+
+def build_results(dta: DataFrame, consortia: Iterable[str] = None, own: Iterable[str] = (),
+                  sources: Dict[tuple, str] = None) -> DataFrame:
+    """
+    Enriched and sorted results for the long file rows in `dta`.  `consortia`
+    adds to the consortium names found in `dta` (see enrich.add_flags); `own`
+    and `sources` describe the consortium rows outside `dta` (see
+    enrich.get_consortium_rows).
+    """
+    dta = dta.rename({'Consortia': 'consortium'}, axis=1)
+
+    # Rows for consortia without results of their own (e.g. NECAP)
+    dta = add_consortium_rows(dta, own, sources)
+
+    if consortia is not None:
+        consortia = set(consortia) | set(dta['consortium'].dropna())
+    dta = enrich(dta, consortia)
+    return dta[COLUMNS].sort_values(COLUMNS)
+
+
+def write_results(df: DataFrame, path_or_buf=None, header: bool = True):
+    return df.to_csv(path_or_buf, columns=COLUMNS, header=header, index=False,
+                     quoting=csv.QUOTE_NONNUMERIC)
+
+
+# %% Incremental ingest
+class ResultLine(NamedTuple):
+    values: tuple
+    text: str
+
+    @classmethod
+    def parse(cls, text: str) -> 'ResultLine':
+        row = next(csv.reader([text]))
+        values = tuple(None if value == '' else _PARSERS.get(name, str)(value)
+                       for name, value in zip(COLUMNS, row))
+        return cls(values, text)
+
+    @property
+    def sort_key(self) -> tuple:
+        # Same order as sort_values(COLUMNS): by each column, missing values last
+        return tuple((1,) if value is None else (0, value) for value in self.values)
+
+    @property
+    def row_key(self) -> tuple:
+        return tuple(self.values[COLUMNS.index(name)] for name in ROW_KEY)
+
+    def get(self, name: str):
+        return self.values[COLUMNS.index(name)]
+
+
+def read_results(path: str) -> Tuple[str, List[str]]:
+    """The header and the (unparsed) lines of a results csv."""
+    with open(path, newline='') as infile:
+        header, *lines = infile.readlines()
+    if next(csv.reader([header])) != COLUMNS:
+        raise ValueError(f'{path} does not have the columns {COLUMNS}')
+    return header, lines
+
+
+def render_lines(df: DataFrame) -> List[ResultLine]:
+    return [ResultLine.parse(line)
+            for line in write_results(df, header=False).splitlines(keepends=True)]
+
+
+def consortium_rows(lines: List[str]) -> Tuple[set, set, Dict[tuple, str]]:
+    """
+    What the results `lines` say about consortia: the names flagged
+    is_consortium, those with rows of their own, and the member each derived
+    row was copied from, by (year, subjgrade, consortium).  A consortium row is
+    derived if a member in its block carries the same estimates; the first
+    such member is taken as its source.
+    """
+    col = {name: i for i, name in enumerate(COLUMNS)}
+    estimates = itemgetter(col['nse'], col['nse_se'], col['nse_re'])
+
+    flagged, members = dict(), dict()
+    for row in csv.reader(lines):
+        block = int(row[col['year']]), row[col['subjgrade']]
+        if row[col['is_consortium']] == 'True':
+            flagged[(*block, row[col['state']])] = estimates(row)
+        elif row[col['consortium']]:
+            members.setdefault((*block, row[col['consortium']]), []).append(
+                (row[col['state']], estimates(row)))
+
+    sources = dict()
+    for key, values in flagged.items():
+        source = next((state for state, est in members.get(key, ()) if est == values), None)
+        if source is not None:
+            sources[key] = source
+    own = {key[2] for key in flagged if key not in sources}
+    return {key[2] for key in flagged}, own, sources
+
+
+def _block(text: str) -> tuple:
+    # (year, subjgrade), the leading sort columns, without parsing the whole line
+    year, subjgrade, _ = text.split(',', 2)
+    return int(year), subjgrade.strip('"')
+
+
+def merge_results(lines: List[str],
+                  new: List[ResultLine]) -> Tuple[List[str], List[int], List[int]]:
+    """
+    Merges the sorted `new` lines into the sorted results `lines`, replacing
+    those with the same ROW_KEY.  Only the (year, subjgrade) blocks the delta
+    touches are parsed; the others are copied as they are.
+
+    Returns the merged lines, the indices of the replaced lines in `lines` and
+    those of the new lines in the merged lines.
+    """
+    keys = {line.row_key for line in new}
+    if len(keys) < len(new):
+        raise ValueError(f'the delta has duplicate rows for {ROW_KEY}')
+
+    merged, replaced, added = [], [], []
+    pos = 0
+    for block, group in groupby(new, key=lambda line: line.values[:2]):
+        lo = bisect_left(lines, block, lo=pos, key=_block)
+        hi = bisect_right(lines, block, lo=lo, key=_block)
+        merged.extend(lines[pos:lo])
+
+        old = []
+        for i in range(lo, hi):
+            line = ResultLine.parse(lines[i])
+            if line.row_key in keys:
+                replaced.append(i)
+            else:
+                old.append((line.sort_key, False, line.text))
+        for _, is_new, text in heapq.merge(old, [(line.sort_key, True, line.text)
+                                                 for line in group]):
+            if is_new:
+                added.append(len(merged))
+            merged.append(text)
+        pos = hi
+    merged.extend(lines[pos:])
+    return merged, replaced, added
+
+
+def verify_merge(path: str, lines: List[str], replaced: List[int], added: List[int]):
+    """
+    Checks the merged file at `path` against the original `lines`: every line
+    outside the delta is unchanged, byte for byte and in order, and the new
+    lines sit in sort order.
+    """
+    _, merged = read_results(path)
+    if len(merged) != len(lines) - len(replaced) + len(added):
+        raise ValueError(f'{path}: {len(merged):,} rows, expected '
+                         f'{len(lines) - len(replaced) + len(added):,}')
+
+    skip_old, skip_new = set(replaced), set(added)
+    untouched = [text for i, text in enumerate(merged) if i not in skip_new]
+    if untouched != [text for i, text in enumerate(lines) if i not in skip_old]:
+        raise ValueError(f'{path}: rows outside the delta changed')
+
+    # The untouched lines kept their order, so checking around each new one suffices
+    for i in added:
+        keys = [ResultLine.parse(text).sort_key for text in merged[max(i-1, 0):i+2]]
+        if keys != sorted(keys):
+            raise ValueError(f'{path}: rows are not in sort order at line {i+2}')
+
+
+def ingest(delta: DataFrame, path: str = RESULTS_FILE, verbose: bool = True) -> List[ResultLine]:
+    """
+    Merges the long file rows in `delta` (a new year, or corrected rows) into
+    the results at `path` and returns the lines added.  Cost grows with the
+    size of the delta; the existing rows are copied without being parsed.
+    """
+    start = perf_counter()
+    header, lines = read_results(path)
+
+    # Consortia flagged in earlier years stay flagged, and existing consortium
+    # rows are only derived again from the member they came from
+    consortia, own, sources = consortium_rows(lines)
+    new = render_lines(build_results(delta, consortia, own, sources))
+    merged, replaced, added = merge_results(lines, new)
+
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', newline='') as outfile:
+        outfile.write(header)
+        outfile.writelines(merged)
+    try:
+        verify_merge(tmp, lines, replaced, added)
+    except ValueError:
+        os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+
+    if verbose:
+        print(f'{len(new):,} rows ingested ({len(replaced):,} replaced), '
+              f'{len(lines) - len(replaced):,} rows unchanged in {perf_counter() - start:.2f}s')
+    return new
+
+
+def check_ingest(workdir: str, seed: int = 0) -> List[str]:
+    """
+    Ingests deltas into results built from synthetic long files and returns
+    the cases whose csv does not byte-match a full rebuild.
+    """
+    from synthdata import make_long_file
+
+    dta = make_long_file(n_states=20, seed=seed)
+    member = dta['Consortia'].notna() & (dta['year'] == 2017) & (dta['subjgrade'] == 'M4')
+    first = ~dta[member].duplicated('Consortia')
+
+    def correct(rows):
+        fixed = dta.copy()
+        fixed.loc[rows, 'nse'] = 250.0
+        return fixed, fixed.loc[rows]
+
+    cases = {'new year': (dta, dta[dta['year'] == 2019])}
+    for consortium in dta.loc[member, 'Consortia'].unique():
+        rows = dta[member & (dta['Consortia'] == consortium)].index
+        cases[f'{consortium}, first member'] = correct(rows[first[rows]][:1])
+        if len(rows) > 1:
+            cases[f'{consortium}, other member'] = correct(rows[1:2])
+
+    failed = []
+    full, path = os.path.join(workdir, 'full.csv'), os.path.join(workdir, 'ingest.csv')
+    for name, (fixed, delta) in cases.items():
+        base = dta[dta['year'] < 2019] if name == 'new year' else dta
+        write_results(build_results(base), path)
+        ingest(delta, path, verbose=False)
+        write_results(build_results(fixed), full)
+        with open(path, 'rb') as a, open(full, 'rb') as b:
+            if a.read() != b.read():
+                failed.append(name)
+    return failed
+
 
 # %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f'Build {RESULTS_FILE} from the long file')
+    parser.add_argument('source', nargs='?', default=f'{DATAPATH}/{DATAFILE}',
+                        help='long file (default: DATAPATH/DATAFILE)')
+    parser.add_argument('--output', default=RESULTS_FILE)
+    parser.add_argument('--delta', action='store_true',
+                        help='the source only holds new or corrected rows; merge them '
+                             'into the existing output instead of rebuilding it')
+    parser.add_argument('--self-check', action='store_true',
+                        help='check --delta against full rebuilds of synthetic data and exit')
+    args = parser.parse_args()
+
+    if args.self_check:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            FAILED = check_ingest(tmpdir)
+        print(f'ingest differs from a full rebuild: {", ".join(FAILED)}' if FAILED
+              else 'ingest matches full rebuilds')
+        sys.exit(1 if FAILED else 0)
+
+    dta = get_reader(args.source)(args.source)
+    if args.delta:
+        ingest(dta, args.output)
+    else:
+        write_results(build_results(dta), args.output)
 
-dta.rename({'Consortia': 'consortium'}, axis=1, inplace=True)
-
-# %% Add NECAP rows
-
-for year in years:
-    datasets = {sg: dta[(dta.subjgrade == sg) & (dta.year == year)]
-                for sg in ('M4', 'M8', 'R4', 'R8')}
-    for sg, results in datasets.items():
-        if 'NECAP' in set(results.consortium):
-            necap_row = results[results.consortium == 'NECAP'].iloc[0]
-            necap_row.state = 'NECAP'
-            necap_row.consortium = nan
-            dta.append(necap_row)
-
-# %% Replace mark
-dta['nse_re_mark'] = dta['nse_re'].apply(lambda val: val >= 0.5)
-
-# %% Exclusion indicator
-dta['exclude'] = dta['IN_SNAKECHART_FILE'].apply(lambda s: s == 'NO')
-
-# %% Consortium indicator
-dta['is_consortium'] = dta['state'].isin(set(dta.consortium))
-
-# %% State abbreviations and fips codes
-st_abbr = us.states.mapping('name', 'abbr')
-st_fips = us.states.mapping('name', 'fips')
-dta['fips'] = dta['state'].apply(lambda st: st_fips.get(st, nan))
-dta['state_abbr'] = dta['state'].apply(lambda st: st_abbr.get(st, nan))
-
-
-# %% Achievement levels
-NAEP_LABELS = ('Below NAEP Basic',
-               'NAEP Basic',
-               'NAEP Proficient',
-               'NAEP Advanced')
-
-NAEP_CUTS = {
-    'M4': (214, 249, 282),
-    'M8': (262, 299, 333),
-    'R4': (208, 238, 268),
-    'R8': (243, 281, 323)
-}
-
-
-def get_level(nse: float, nse_se: float, subjgrade: str):
-
-    if subjgrade in NAEP_CUTS and pd.notna(nse):
-        upper = nse + 1.96*nse_se
-        for i, cut in enumerate(NAEP_CUTS[subjgrade]):
-            if upper < cut:
-                return NAEP_LABELS[i]
-
-        return NAEP_LABELS[-1]
-
-    return None
-
-dta['level'] = dta[['nse', 'nse_se', 'subjgrade']].apply(lambda row: get_level(*row), axis=1)
-
-# %% Export required columns
-cols = ['year',
-        'subjgrade',
-        'fips',
-        'state_abbr',
-        'state',
-        'consortium',
-        'nse',
-        'nse_se',
-        'nse_re',
-        'level',
-        'nse_re_mark',
-        'exclude',
-        'is_consortium']
-
-dta[cols].sort_values(cols).to_csv(
-    'StateMappingResults.csv', columns=cols, index=False, quoting=csv.QUOTE_NONNUMERIC)
 # %%
@@ -0,0 +1,107 @@
+# %%
+# Incremental builds.  Each output file is recorded in a manifest next to it
+# with a digest of everything it is built from (its data slice, the template
+# and the generator code); on the next --incremental run, outputs whose digest
+# has not changed are skipped.
+
+from __future__ import annotations
+
+import hashlib
+import inspect
+import json
+import os
+from argparse import ArgumentParser
+from typing import TYPE_CHECKING, Dict
+
+from lazy import lazy_import
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+pd = lazy_import('pandas')
+
+MANIFEST_NAME = '.manifest.json'
+
+
+def hash_frame(df: DataFrame) -> str:
+    """Digest of the values (not the index) of `df`, including column names."""
+    sha = hashlib.sha1(json.dumps([str(col) for col in df.columns]).encode())
+    sha.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return sha.hexdigest()
+
+
+def hash_file(path: str) -> str:
+    sha = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def hash_values(*values) -> str:
+    """Digest of JSON-able values (e.g. other digests, names, table rows)."""
+    return hashlib.sha1(json.dumps(values, default=str).encode()).hexdigest()
+
+
+def code_version(*objects) -> str:
+    """Digest of the source files defining `objects` (modules, classes, functions)."""
+    paths = dict.fromkeys(os.path.abspath(inspect.getfile(obj)) for obj in objects)
+    return hash_values(*(hash_file(path) for path in paths))
+
+
+class Manifest:
+
+    def __init__(self, outpath: str, force: bool = False, name: str = MANIFEST_NAME) -> None:
+        self.outpath = outpath
+        self.path = os.path.join(outpath, name)
+        self.force = force
+        self.rebuilt, self.skipped = [], []
+
+        self._entries: Dict[str, str] = dict()
+        self._pending: Dict[str, str] = dict()
+        if os.path.exists(self.path):
+            with open(self.path) as infile:
+                self._entries = json.load(infile)
+
+    def needs_build(self, name: str, digest: str) -> bool:
+        """False if `name` exists and was last built from the same inputs."""
+        if (not self.force and self._entries.get(name) == digest
+                and os.path.exists(os.path.join(self.outpath, name))):
+            self.skipped.append(name)
+            return False
+
+        self._pending[name] = digest
+        return True
+
+    def built(self, name: str):
+        self._entries[name] = self._pending.pop(name)
+        self.rebuilt.append(name)
+
+    def discard(self, name: str):
+        """Forgets `name`, e.g. when writing it failed after the job succeeded."""
+        self._entries.pop(name, None)
+        if name in self.rebuilt:
+            self.rebuilt.remove(name)
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as outfile:
+            json.dump(self._entries, outfile, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def report(self) -> str:
+        return f'{len(self.rebuilt)} rebuilt, {len(self.skipped)} unchanged and skipped'
+
+
+def add_manifest_arguments(parser: ArgumentParser):
+    parser.add_argument('--incremental', action='store_true',
+                        help=f'skip outputs whose inputs have not changed (see {MANIFEST_NAME})')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild every output and refresh the manifest')
+
+
+def get_manifest(args, outpath: str):
+    """The manifest to build against, or None for a plain full build."""
+    if args.incremental or args.force:
+        return Manifest(outpath, force=args.force)
+    return None
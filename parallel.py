@@ -0,0 +1,100 @@
+# %%
+# NOTE: Every state / (year, subjgrade) table is independent, so the generator
+#       scripts hand their jobs to iter_jobs.  Each worker process builds its data
+#       context (TableData, TableGenerator, ...) once in the pool initializer and
+#       reuses it for every job it is given.
+
+import os
+import traceback
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from time import perf_counter
+from typing import Any, Callable, Hashable, Iterable, Iterator, List, NamedTuple, Optional
+
+import instrument
+
+_context = None
+
+
+class JobResult(NamedTuple):
+    key: Hashable
+    ok: bool
+    seconds: float
+    error: Optional[str] = None
+    value: Any = None
+    profile: Optional[list] = None
+
+
+def _init_worker(factory: Callable, args: tuple):
+    global _context
+    # Drop any records inherited from the parent through fork
+    instrument.collect()
+    _context = factory(*args)
+
+
+def _run_job(task: Callable, key: Hashable, context: Any = None) -> JobResult:
+    in_worker = context is None
+    start = perf_counter()
+    try:
+        value = task(_context if in_worker else context, key)
+        result = JobResult(key, True, perf_counter()-start, value=value)
+    except Exception:
+        result = JobResult(key, False, perf_counter()-start, traceback.format_exc())
+
+    if in_worker and instrument.is_enabled():
+        result = result._replace(profile=instrument.collect())
+    return result
+
+
+def iter_jobs(task: Callable, keys: Iterable[Hashable], factory: Callable, args: tuple = (),
+              jobs: int = 1, context: Any = None) -> Iterator[JobResult]:
+    """
+    Runs `task(context, key)` for every key and yields a JobResult per key,
+    in the order of `keys`.  With jobs > 1 the work is spread over a process
+    pool whose workers each call `factory(*args)` once to build their context;
+    otherwise the jobs run in-process against `context` (built from the factory
+    if not given).
+    """
+    keys = list(keys)
+    jobs = jobs or os.cpu_count() or 1
+
+    if jobs == 1 or len(keys) < 2:
+        if context is None:
+            context = factory(*args)
+        for key in keys:
+            yield _run_job(task, key, context)
+        return
+
+    with ProcessPoolExecutor(min(jobs, len(keys)), initializer=_init_worker,
+                             initargs=(factory, args)) as pool:
+        for result in pool.map(partial(_run_job, task), keys):
+            instrument.merge(result.profile)
+            yield result
+
+
+def add_run_arguments(parser: ArgumentParser):
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes (0 = one per CPU)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='record per-stage timings and write them to FILE (.json/.csv)')
+
+
+def apply_run_arguments(args):
+    if args.profile:
+        instrument.enable(args.profile)
+
+
+def print_result(result: JobResult, name: str = None):
+    name = name or str(result.key)
+    if result.ok:
+        print(f'{name} ({result.seconds:.2f}s)')
+    else:
+        print(f'{name} FAILED ({result.seconds:.2f}s)\n{result.error}')
+
+
+def print_summary(results: List[JobResult]):
+    failed = [r for r in results if not r.ok]
+    total = sum(r.seconds for r in results)
+    print(f'{len(results)-len(failed)} succeeded, {len(failed)} failed, '
+          f'{total:.2f}s job time')
@@ -0,0 +1,192 @@
+# %%
+# Partitioned copies of the source data, so that a job only opens the rows it
+# renders instead of the whole long file / StateMappingResults.csv.
+#
+#   python partition.py StateMappingResults.csv partitions/profiles --by state --consortia consortium
+#   python partition.py "long file.xlsx" partitions/snakechart --by year subjgrade
+#
+# Each partition is a datacache column directory (memory-mappable .npy files)
+# holding the raw source rows; the schema is applied when a generator opens it.
+# With --consortia, a state's partition also holds the rows of the consortia it
+# belongs to, which the state tables report next to its own results.
+#
+# NOTE: The index records the source's path, mtime and size.  Partitions of a
+#       source that has changed since are refused rather than rendered from
+#       (and recorded in an incremental manifest as if they were current).
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import shutil
+from typing import TYPE_CHECKING, Callable, Dict, Hashable, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+from common import SnakeTableGenerator, StateTableGenerator
+from datacache import _source_key, load_arrays, load_columns, load_frame, save_columns
+from lazy import lazy_import
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+pd = lazy_import('pandas')
+
+INDEX_FILE = 'index.json'
+
+
+def with_consortia(df: DataFrame, state: str, column: str) -> DataFrame:
+    """The rows of `state` plus those of the consortia it belongs to."""
+    own = df.state == state
+    consortia = df.loc[own, column].dropna().unique()
+    return df[own | df.state.isin(consortia)]
+
+
+def iter_partitions(df: DataFrame, by: Sequence[str],
+                    consortia: str = None) -> Iterator[Tuple[tuple, DataFrame]]:
+    if consortia:
+        # Consortium rows only ride along with their member states
+        members = df.loc[~df.state.isin(df[consortia].dropna().unique()), 'state']
+        for state in members.dropna().unique():
+            yield (state,), with_consortia(df, state, consortia)
+        return
+
+    for key, part in df.groupby(by[0] if len(by) == 1 else list(by), sort=False):
+        yield key if isinstance(key, tuple) else (key,), part
+
+
+def _dirname(key: tuple) -> str:
+    return re.sub(r'[^\w.-]+', '_', '_'.join(str(value) for value in key))
+
+
+def write_partitions(df: DataFrame, root: str, by: Sequence[str], consortia: str = None,
+                     source: dict = None, views: dict = None) -> int:
+    """
+    Replaces the partitions under `root`; returns how many were written.
+    `views` holds the global views of the whole source per generator class
+    (see TableGenerator.global_views), which a partition cannot derive.
+    """
+    tmproot = f'{root}.tmp'
+    shutil.rmtree(tmproot, ignore_errors=True)
+    os.makedirs(tmproot)
+
+    index = []
+    for key, part in iter_partitions(df, by, consortia):
+        key = [value.item() if hasattr(value, 'item') else value for value in key]
+        name = _dirname(key)
+        save_columns(part.reset_index(drop=True), os.path.join(tmproot, name))
+        index.append({'key': key, 'path': name, 'rows': len(part)})
+
+    with open(os.path.join(tmproot, INDEX_FILE), 'w') as outfile:
+        json.dump({'by': list(by), 'consortia': consortia, 'source': source,
+                   'columns': list(df.columns), 'views': views or {},
+                   'partitions': index}, outfile, indent=1)
+
+    shutil.rmtree(root, ignore_errors=True)
+    os.rename(tmproot, root)
+    return len(index)
+
+
+class PartitionStore:
+    """The partitions under `root`; raises ValueError if their source has changed."""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        with open(os.path.join(root, INDEX_FILE)) as infile:
+            index = json.load(infile)
+        self.by: List[str] = index['by']
+        self.source: dict = index.get('source')
+        self.columns: List[str] = index['columns']
+        self.views: Dict[str, dict] = index.get('views') or {}
+        self._paths: Dict[tuple, str] = {
+            tuple(part['key']): part['path'] for part in index['partitions']}
+        if not self.is_current():
+            raise ValueError(f'{root} does not match {self.source["source"]} any more; '
+                             'run partition.py again')
+
+    def is_current(self) -> bool:
+        """Whether the source is unchanged (or unknown) since it was partitioned."""
+        if not self.source:
+            return True
+        try:
+            return _source_key(self.source['source'], {}) == self.source
+        except OSError:
+            return False
+
+    def keys(self) -> List[tuple]:
+        return list(self._paths)
+
+    def load(self, key: Hashable, mmap_mode: str = 'r') -> DataFrame:
+        """
+        The rows of partition `key` (a value, or a tuple for several columns);
+        a key without any rows gets an empty frame.
+        """
+        key = key if isinstance(key, tuple) else (key,)
+        if key not in self._paths:
+            return pd.DataFrame(columns=self.columns)
+        df, _ = load_columns(os.path.join(self.root, self._paths[key]), mmap_mode)
+        return df
+
+    def load_arrays(self, key: Hashable, mmap_mode: str = 'r') -> Dict[str, np.ndarray]:
+        """Like load(), as NumPy columns and without importing pandas."""
+        key = key if isinstance(key, tuple) else (key,)
+        if key not in self._paths:
+            return {name: np.empty(0, dtype=object) for name in self.columns}
+        data, _ = load_arrays(os.path.join(self.root, self._paths[key]), mmap_mode)
+        return data
+
+
+class PartitionedContext:
+    """
+    A job context (see parallel.iter_jobs) that opens `cls.from_partition(store,
+    key)` for each job instead of holding the whole dataset.  `key` maps a job
+    to its partition key.
+    """
+
+    def __init__(self, root: str, cls: type, key: Callable = None) -> None:
+        self.store = PartitionStore(root)
+        self.cls = cls
+        self.key = key
+
+    def for_job(self, job):
+        return self.cls.from_partition(self.store, self.key(job) if self.key else job)
+
+
+def generator_views(df: DataFrame) -> dict:
+    """The global views of the table generators over a long file frame."""
+    if 'IN_SNAKECHART_FILE' not in df.columns:
+        return {}
+    return {cls.__name__: cls.from_frame(df).global_views()
+            for cls in (SnakeTableGenerator, StateTableGenerator)}
+
+
+def add_partition_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--partition-root', metavar='DIR',
+                        help='open each job\'s rows from partitions written by partition.py')
+
+
+def check_partition_root(parser: argparse.ArgumentParser, args):
+    """Exits with an error if --partition-root is missing or out of date."""
+    if args.partition_root:
+        try:
+            PartitionStore(args.partition_root)
+        except (OSError, ValueError) as err:
+            parser.error(str(err))
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Partition a source file for the generators')
+    parser.add_argument('source')
+    parser.add_argument('root', help='output directory (replaced)')
+    parser.add_argument('--by', nargs='+', default=['state'], help='partition columns')
+    parser.add_argument('--consortia', metavar='COLUMN',
+                        help='partition by state, adding the rows of the consortia in COLUMN')
+    args = parser.parse_args()
+
+    DATA = load_frame(args.source)
+    N = write_partitions(DATA, args.root, ['state'] if args.consortia else args.by,
+                         args.consortia, _source_key(args.source, {}), generator_views(DATA))
+    print(f'{N} partitions of {len(DATA):,} rows written to {args.root}')
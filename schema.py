@@ -0,0 +1,63 @@
+# %%
+# Declared column types for the long file and StateMappingResults.csv.  Repeated
+# strings become categoricals, year/fips small ints and the indicator columns
+# real bools, which keeps the frames small and the equality filters fast.
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from lazy import lazy_import
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+pd = lazy_import('pandas')
+
+MAPPING_SCHEMA = {
+    'year': 'int16',
+    'subjgrade': 'category',
+    'fips': 'Int8',
+    'state_abbr': 'category',
+    'state': 'category',
+    'consortium': 'category',
+    'Consortia': 'category',
+    'level': 'category',
+    'mark': 'category',
+    'IN_SNAKECHART_FILE': 'category',
+    'nse_re_mark': 'bool',
+    'exclude': 'bool',
+    'is_consortium': 'bool'
+}
+
+TRUE_VALUES = (True, 'True', 'TRUE', 'true')
+
+
+def _convert(col: pd.Series, dtype: str) -> pd.Series:
+    if dtype == 'bool' and col.dtype != bool:
+        return col.isin(TRUE_VALUES)
+    if dtype.lower().startswith('int') and col.dtype == object:
+        col = pd.to_numeric(col)
+    return col.astype(dtype)
+
+
+def memory_usage(df: DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+def apply_schema(df: DataFrame, schema: dict = None, verbose: bool = False) -> DataFrame:
+    """Returns `df` with the schema's dtypes applied to the columns it has."""
+    schema = MAPPING_SCHEMA if schema is None else schema
+    before = memory_usage(df) if verbose else 0
+
+    df = df.copy(deep=False)
+    for name, dtype in schema.items():
+        if name in df.columns and str(df[name].dtype) != dtype:
+            df[name] = _convert(df[name], dtype)
+
+    if verbose:
+        after = memory_usage(df)
+        print(f'Memory: {before/1024:,.1f} KiB -> {after/1024:,.1f} KiB '
+              f'({len(df):,} rows)')
+
+    return df
@@ -0,0 +1,371 @@
+# %%
+# Renders tables on request over HTTP, so a data fix does not mean regenerating
+# and re-uploading every workbook.
+#
+#   python server.py --port 8000
+#   curl -o Texas.xlsx localhost:8000/profile/Texas.xlsx
+#
+#   /profile/<state>.xlsx           state profile (StateMappingResults.csv)
+#   /state/<state>.xlsx             state table (long file, needs source_state.xlsx)
+#   /snake/<year><letter>.xlsx      snake chart, e.g. /snake/2019a.xlsx (long file)
+#   /metrics                        request latency and cache counters as JSON
+#
+# The data and templates stay loaded; a data file that changes on disk is
+# reloaded on the next request.  Rendered workbooks are kept in an LRU cache
+# bounded by their total size and keyed by a digest of the table's input rows
+# and template, so after a reload only the tables whose rows changed are
+# rendered again.  The digests of the input rows are worked out when the data
+# is (re)loaded, so a request only looks its table up.
+#
+# NOTE: Renders are serialized (openpyxl work holds the GIL anyway, and it keeps
+#       the shared templates and compiled layouts safe); cache hits are served
+#       concurrently.  make_server(service, port=0) runs on any free port, e.g.
+#       for a local test client on a thread.
+
+import argparse
+import json
+import os
+import re
+import threading
+import traceback
+from collections import OrderedDict, deque
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+from bundle import workbook_bytes
+from common import SnakeTableGenerator, StateTableGenerator
+from datacache import load_frame
+from gen_state_profiles import DATAFILE as PROFILE_FILE
+from gen_state_profiles import LAYOUTS, TableData, get_state_tables, get_states
+from generate_snakechart import DATAPATH, DATAFILE
+from manifest import hash_frame, hash_values
+from templates import TEMPLATES
+
+XLSX_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+STATE_TEMPLATE = StateTableGenerator.template_path
+
+_ROUTE_RE = re.compile(r'^/(\w+)/(.+)\.xlsx$')
+_SNAKE_RE = re.compile(r'^(?:snake_chart_table_)?(\d{4})([a-z])$')
+
+
+# %%
+
+class RenderCache:
+    """LRU cache of rendered xlsx bytes, bounded by their total size."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def peek(self, key: str) -> Optional[bytes]:
+        """Like get(), without counting a hit or miss."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'bytes': self.size,
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': round(self.hits / lookups, 4) if lookups else None}
+
+
+class RequestStats:
+    """Request counts and latency per route, over the last `window` requests."""
+
+    def __init__(self, window: int = 1000) -> None:
+        self.window = window
+        self._routes: Dict[str, dict] = dict()
+        self._lock = threading.Lock()
+
+    def record(self, route: str, seconds: float, status: int, hit: bool = False):
+        with self._lock:
+            stats = self._routes.setdefault(route, {
+                'requests': 0, 'errors': 0, 'hits': 0,
+                'latency': deque(maxlen=self.window)})
+            stats['requests'] += 1
+            stats['errors'] += status >= 400
+            stats['hits'] += hit
+            stats['latency'].append(seconds)
+
+    def snapshot(self) -> dict:
+        out = dict()
+        with self._lock:
+            for route, stats in self._routes.items():
+                latency = sorted(stats['latency'])
+                out[route] = dict(
+                    {k: v for k, v in stats.items() if k != 'latency'},
+                    hit_rate=round(stats['hits'] / stats['requests'], 4),
+                    latency_ms={name: round(1000*latency[int(q*(len(latency)-1))], 3)
+                                for name, q in (('p50', .5), ('p95', .95), ('max', 1))})
+        return out
+
+
+class DataSource:
+    """The object `loader(path)` builds, reloaded when `path` changes on disk."""
+
+    def __init__(self, path: str, loader: Callable) -> None:
+        self.path = path
+        self.loader = loader
+        self.loads = 0
+        self._stat = None
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        stat = os.stat(self.path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if key != self._stat:
+                self._value = self.loader(self.path)
+                self._stat = key
+                self.loads += 1
+            return self._value
+
+
+class RouteData(NamedTuple):
+    """What a route renders from, and the digest of each table's input rows."""
+    source: Any
+    digests: Dict[Any, str]
+    abbrs: Dict[str, str] = None
+
+
+def _load_profiles(path: str) -> dict:
+    td = TableData(path)
+    abbrs = dict(get_states(td))
+    return {'profile': RouteData(td, {state: hash_frame(td.get_input_rows(state))
+                                      for state in abbrs}, abbrs)}
+
+
+def _load_long_file(path: str) -> dict:
+    # One read of the long file for both generators, with their views built
+    # now rather than on the first request
+    df = load_frame(path)
+    state = StateTableGenerator.from_frame(df).load()
+    snake = SnakeTableGenerator.from_frame(df).load()
+    return {'state': RouteData(state, {name: hash_frame(rows)
+                                       for name, rows in state.state_data.groupby('state')}),
+            'snake': RouteData(snake, {job: hash_values(snake.partitions.get(job, []))
+                                       for job in snake.jobs()})}
+
+
+SOURCE_ROUTES = {'profiles': ('profile',), 'long_file': ('state', 'snake')}
+
+
+class Table(NamedTuple):
+    filename: str
+    digest: str
+    render: Callable
+
+
+# %%
+
+class RenderService:
+    """
+    Renders the tables from resident data.  Each route maps a table name to a
+    Table (its digest and how to render it), or None if there is no such table.
+    """
+
+    def __init__(self, profiles: str = None, long_file: str = None,
+                 cache_bytes: int = 256 << 20) -> None:
+        self.cache = RenderCache(cache_bytes)
+        self.stats = RequestStats()
+        self.sources: Dict[str, DataSource] = dict()
+        self._render_lock = threading.Lock()
+
+        # Each source loads into the objects its routes render from
+        if profiles:
+            self.sources['profiles'] = DataSource(profiles, _load_profiles)
+        if long_file:
+            self.sources['long_file'] = DataSource(long_file, _load_long_file)
+        self.routes = {route: name for name, routes in SOURCE_ROUTES.items()
+                       if name in self.sources for route in routes}
+        # The state table template is not kept with the code; without it
+        # /state is not served rather than failing on every request
+        if not os.path.exists(STATE_TEMPLATE):
+            self.routes.pop('state', None)
+
+    def load(self):
+        for source in self.sources.values():
+            source.get()
+
+    def _profile(self, data: RouteData, name: str) -> Optional[Table]:
+        if name not in data.digests:
+            return None
+        td, abbr = data.source, data.abbrs[name]
+        digest = hash_values('profile', name, abbr, data.digests[name], LAYOUTS.digest())
+        return Table(f'{name}.xlsx', digest,
+                     lambda: LAYOUTS.render(name, abbr, get_state_tables(td, name)))
+
+    def _state(self, data: RouteData, name: str) -> Optional[Table]:
+        if name not in data.digests:
+            return None
+        tbl = data.source
+        digest = hash_values('state', name, data.digests[name], TEMPLATES.digest(STATE_TEMPLATE))
+        return Table(f'{name}.xlsx', digest, lambda: tbl.generate(name))
+
+    def _snake(self, data: RouteData, name: str) -> Optional[Table]:
+        tbl, match = data.source, _SNAKE_RE.match(name)
+        subjgrades = {letter: sg for sg, letter in tbl.letters.items()}
+        if not match or match[2] not in subjgrades:
+            return None
+        job = int(match[1]), subjgrades[match[2]]
+        if job not in data.digests:
+            return None
+        digest = hash_values('snake', job, data.digests[job], TEMPLATES.digest(tbl.template_path))
+        return Table(tbl.filename(*job), digest, lambda: tbl.generate(*job))
+
+    def find(self, route: str, name: str) -> Optional[Table]:
+        if route not in self.routes:
+            return None
+        return getattr(self, f'_{route}')(self.sources[self.routes[route]].get()[route], name)
+
+    def get(self, table: Table) -> Tuple[bytes, bool]:
+        """The xlsx bytes of `table` and whether they came from the cache."""
+        data = self.cache.get(table.digest)
+        if data is not None:
+            return data, True
+
+        with self._render_lock:
+            # Another request may have rendered it while this one waited
+            data = self.cache.peek(table.digest)
+            if data is None:
+                data = workbook_bytes(table.render())
+                self.cache.put(table.digest, data)
+        return data, False
+
+    def metrics(self) -> dict:
+        return {'cache': self.cache.stats(), 'routes': self.stats.snapshot(),
+                'sources': {name: {'path': source.path, 'loads': source.loads}
+                            for name, source in self.sources.items()}}
+
+
+# %%
+
+class TableRequestHandler(BaseHTTPRequestHandler):
+
+    server: 'TableServer'
+
+    def do_GET(self):
+        start = perf_counter()
+        path = unquote(urlsplit(self.path).path)
+        if path == '/metrics':
+            self._send(HTTPStatus.OK, json.dumps(self.server.service.metrics(), indent=1).encode(),
+                       'application/json')
+            return
+
+        match = _ROUTE_RE.match(path)
+        route = match[1] if match else 'other'
+        status, hit = HTTPStatus.OK, False
+        try:
+            table = match and self.server.service.find(route, match[2])
+            if table:
+                data, hit = self.server.service.get(table)
+                self._send(status, data, XLSX_TYPE, {
+                    'Content-Disposition': f'attachment; filename="{table.filename}"',
+                    'X-Cache': 'HIT' if hit else 'MISS',
+                    'X-Render-Seconds': f'{perf_counter()-start:.4f}'})
+            else:
+                status = HTTPStatus.NOT_FOUND
+                self._send(status, f'No table at {path}\n'.encode(), 'text/plain')
+        except Exception:
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            self.log_error('%s', traceback.format_exc())
+            self._send(status, b'Rendering failed\n', 'text/plain')
+        finally:
+            self.server.service.stats.record(route, perf_counter()-start, status, hit)
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class TableServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, service: RenderService, quiet: bool = False) -> None:
+        super().__init__(address, TableRequestHandler)
+        self.service = service
+        self.quiet = quiet
+
+
+def make_server(service: RenderService, host: str = '127.0.0.1', port: int = 8000,
+                quiet: bool = False) -> TableServer:
+    return TableServer((host, port), service, quiet)
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve tables rendered on request')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--profiles', default=PROFILE_FILE,
+                        help='StateMappingResults.csv for the state profiles')
+    parser.add_argument('--long-file', default=f'{DATAPATH}/{DATAFILE}',
+                        help='long file for the state tables and snake charts')
+    parser.add_argument('--cache-mb', type=float, default=256,
+                        help='size limit of the rendered workbook cache')
+    parser.add_argument('--quiet', action='store_true', help='do not log every request')
+    args = parser.parse_args()
+
+    sources = {'profiles': args.profiles, 'long_file': args.long_file}
+    for name, path in sources.items():
+        if not os.path.exists(path):
+            print(f'{path} not found; its tables are not served')
+            sources[name] = None
+
+    service = RenderService(sources['profiles'], sources['long_file'],
+                            int(args.cache_mb * (1 << 20)))
+    service.load()
+    if 'long_file' in service.sources and 'state' not in service.routes:
+        print(f'{STATE_TEMPLATE} not found; state tables are not served')
+    server = make_server(service, args.host, args.port, args.quiet)
+    print(f'Serving on http://{args.host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# %%
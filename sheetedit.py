@@ -0,0 +1,38 @@
+# %%
+# Worksheet edits addressed by (row, column), with the merged ranges indexed by
+# their first row so that row-level edits do not rescan the sheet.
+
+from collections import defaultdict
+from typing import Any, Dict, List, Sequence
+
+from openpyxl.worksheet.cell_range import CellRange
+from openpyxl.worksheet.worksheet import Worksheet
+
+
+class SheetEditor:
+
+    def __init__(self, ws: Worksheet) -> None:
+        self.ws = ws
+        self._merged: Dict[int, List[CellRange]] = defaultdict(list)
+        for rng in ws.merged_cells.ranges:
+            self._merged[rng.min_row].append(rng)
+
+    def write_row(self, row: int, values: Sequence[Any], start_col: int = 1):
+        for j, value in enumerate(values):
+            self.ws.cell(row, start_col+j).value = value
+
+    def merged_at(self, row: int, col: int = 1) -> List[CellRange]:
+        """Merged ranges whose top-left cell is (row, col)."""
+        return [rng for rng in self._merged.get(row, ()) if rng.min_col == col]
+
+    def merge_row(self, row: int, start_col: int, end_col: int):
+        rng = CellRange(min_col=start_col, min_row=row, max_col=end_col, max_row=row)
+        self.ws.merge_cells(rng.coord)
+        if rng not in self._merged[row]:
+            self._merged[row].append(rng)
+
+    def drop_merged(self, row: int, col: int = 1):
+        """Forgets the merged ranges starting at (row, col) without touching the cells."""
+        for rng in self.merged_at(row, col):
+            self.ws.merged_cells.remove(rng)
+            self._merged[row].remove(rng)
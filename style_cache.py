@@ -0,0 +1,68 @@
+# %%
+# Interned cell styles.  openpyxl keeps one StyleArray of ids (font, fill,
+# border, ...) per cell, and the attribute setters (cell.border = ...) look the
+# style objects up in the workbook's lists on every call.  A StyleRegistry
+# resolves each distinct style once per workbook and hands the same StyleArray
+# to every cell that uses it.
+#
+# NOTE: The shared arrays must not be modified in place, which is what the
+#       cell.font/.border/... setters do.  Restyle such cells through the
+#       registry (or give them their own copy of the array first).
+
+from copy import copy
+from typing import Dict, Tuple
+
+import openpyxl as xl
+from openpyxl.cell.cell import Cell
+from openpyxl.styles import Side
+from openpyxl.styles.cell_style import StyleArray
+
+THIN_BLACK = Side('thin', '000000')
+
+# StyleArray attribute -> workbook collection, as in openpyxl.styles.styleable
+_COLLECTIONS = {
+    'font': ('fontId', '_fonts'),
+    'fill': ('fillId', '_fills'),
+    'border': ('borderId', '_borders'),
+    'protection': ('protectionId', '_protections'),
+    'alignment': ('alignmentId', '_alignments'),
+}
+
+
+class StyleRegistry:
+
+    def __init__(self, wb: xl.Workbook) -> None:
+        self.wb = wb
+        self._styles: Dict[Tuple[int, ...], StyleArray] = dict()
+        self._bottom: Dict[Tuple[Tuple[int, ...], Side], StyleArray] = dict()
+
+    def intern(self, style: StyleArray) -> StyleArray:
+        key = tuple(style)
+        shared = self._styles.get(key)
+        if shared is None:
+            shared = self._styles[key] = StyleArray(key)
+        return shared
+
+    def of(self, cell: Cell) -> StyleArray:
+        return self.intern(cell._style)
+
+    def derive(self, style: StyleArray, **attrs) -> StyleArray:
+        """`style` with some of font/fill/border/protection/alignment replaced."""
+        new = StyleArray(style)
+        for name, value in attrs.items():
+            key, collection = _COLLECTIONS[name]
+            setattr(new, key, getattr(self.wb, collection).add(value))
+        return self.intern(new)
+
+    def with_bottom(self, style: StyleArray, side: Side = THIN_BLACK) -> StyleArray:
+        """`style` with its border's bottom edge set to `side`."""
+        key = (tuple(style), side)
+        shared = self._bottom.get(key)
+        if shared is None:
+            border = copy(self.wb._borders[style.borderId])
+            border.bottom = side
+            shared = self._bottom[key] = self.derive(style, border=border)
+        return shared
+
+    def __len__(self) -> int:
+        return len(self._styles)
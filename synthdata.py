@@ -0,0 +1,85 @@
+# %%
+# Synthetic long file / StateMappingResults.csv generator for benchmarking the
+# table pipeline at sizes beyond the real data.
+
+import csv
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+
+from enrich import add_consortium_rows, add_flags, add_levels
+
+YEARS = (2007, 2009, 2011, 2013, 2015, 2017, 2019)
+SUBJGRADES = ('M4', 'M8', 'R4', 'R8')
+CONSORTIA = ('ACT', 'NECAP', 'PARCC', 'SBAC')
+
+MAPPING_COLUMNS = ['year', 'subjgrade', 'fips', 'state_abbr', 'state', 'consortium',
+                   'nse', 'nse_se', 'nse_re', 'level', 'nse_re_mark', 'exclude',
+                   'is_consortium']
+
+
+def make_long_file(n_states: int = 52, years: Sequence[int] = YEARS,
+                   subjgrades: Sequence[str] = SUBJGRADES, n_consortia: int = 4,
+                   seed: int = 0) -> DataFrame:
+    """
+    Long file shaped frame: one row per state, year and subjgrade plus one row
+    per consortium with results of its own (all but the first consortium, which
+    is NECAP-like and only carried by its members).
+    """
+    rng = np.random.default_rng(seed)
+    states = [f'State {i:03d}' for i in range(1, n_states+1)]
+    consortia = [CONSORTIA[i] if i < len(CONSORTIA) else f'CONS{i+1}'
+                 for i in range(n_consortia)]
+
+    index = pd.MultiIndex.from_product([years, subjgrades, states],
+                                       names=['year', 'subjgrade', 'state'])
+    df = index.to_frame(index=False)
+    n = len(df)
+
+    # Roughly half of the states belong to a consortium in any year, for all
+    # subjects and grades
+    df['Consortia'] = None
+    if consortia:
+        member = pd.Series(rng.random(len(years)*n_states) < 0.5,
+                           index=pd.MultiIndex.from_product([years, states]))
+        picks = pd.Series(rng.choice(consortia, len(member)), index=member.index)
+        df['Consortia'] = picks.where(member, None).reindex(
+            pd.MultiIndex.from_frame(df[['year', 'state']])).to_numpy()
+
+    df['nse'] = np.where(rng.random(n) < 0.03, np.nan, rng.uniform(180, 340, n))
+    df['nse_se'] = np.where(rng.random(n) < 0.02, np.nan, rng.uniform(0.5, 3, n))
+    df['nse_re'] = np.where(rng.random(n) < 0.02, np.nan, rng.uniform(0, 0.8, n))
+    df['mark'] = np.where(df['nse_re'] >= 0.5, '!', '')
+    df['IN_SNAKECHART_FILE'] = np.where(rng.random(n) < 0.1, 'NO', 'YES')
+
+    # Consortia reporting their own results
+    own = df[df['Consortia'].isin(consortia[1:])].drop_duplicates(
+        ['year', 'subjgrade', 'Consortia'])
+    own = own.assign(state=own['Consortia'], Consortia=None,
+                     nse=rng.uniform(180, 340, len(own)))
+
+    return pd.concat([df, own], ignore_index=True)
+
+
+def make_mapping_results(*args, **kwargs) -> DataFrame:
+    """StateMappingResults.csv shaped frame, enriched as in longfile.py."""
+    dta = make_long_file(*args, **kwargs).rename({'Consortia': 'consortium'}, axis=1)
+    dta = add_levels(add_flags(add_consortium_rows(dta)))
+
+    # fips stay within the two-digit range of real state codes
+    states = dta.loc[~dta['is_consortium'], 'state'].unique()
+    codes = pd.Series(range(len(states)), index=states)
+    dta['fips'] = dta['state'].map(codes % 99 + 1)
+    dta['state_abbr'] = dta['state'].map('S' + (codes+1).astype(str).str.zfill(3))
+    return dta[MAPPING_COLUMNS].sort_values(MAPPING_COLUMNS)
+
+
+def write_long_file(path: str, *args, **kwargs):
+    make_long_file(*args, **kwargs).to_csv(path, index=False)
+
+
+def write_mapping_results(path: str, *args, **kwargs):
+    make_mapping_results(*args, **kwargs).to_csv(
+        path, columns=MAPPING_COLUMNS, index=False, quoting=csv.QUOTE_NONNUMERIC)
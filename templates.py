@@ -0,0 +1,134 @@
+# %%
+# NOTE: Parsing an xlsx template (zip + styles.xml + sheets) is the largest fixed
+#       cost per output file, so templates are parsed once into a pristine master
+#       workbook and handed out as deep copies.
+
+import hashlib
+import os
+import re
+import zipfile
+from copy import deepcopy
+from io import BytesIO
+from typing import Dict, NamedTuple
+
+import openpyxl as xl
+from openpyxl.utils.indexed_list import IndexedList
+from openpyxl.worksheet.table import TableList
+
+import instrument
+
+STYLES_PART = 'xl/styles.xml'
+
+# openpyxl throws an error when loading an xlsx with MS Sans Serif in the
+# styles.xml.  Dropping the name/family of those fonts (rather than the whole
+# <font> entry) keeps the font indices referenced by cellXfs intact.
+_FONT_RE = re.compile(rb'<font>.*?</font>', re.S)
+_BAD_FONT_RE = re.compile(rb'<(?:name|family) val="[^"]*"\s*/>')
+
+
+def strip_ms_sans_serif(styles_xml: bytes) -> bytes:
+    def fix(match):
+        font = match.group(0)
+        if b'MS Sans Serif' not in font:
+            return font
+        return _BAD_FONT_RE.sub(b'', font)
+
+    return _FONT_RE.sub(fix, styles_xml)
+
+
+def clean_template(raw: bytes) -> bytes:
+    with zipfile.ZipFile(BytesIO(raw)) as src:
+        styles = src.read(STYLES_PART)
+        if b'MS Sans Serif' not in styles:
+            return raw
+
+        out = BytesIO()
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as dst:
+            for info in src.infolist():
+                data = src.read(info)
+                if info.filename == STYLES_PART:
+                    data = strip_ms_sans_serif(data)
+                dst.writestr(info, data)
+
+    return out.getvalue()
+
+
+def clone_workbook(master: xl.Workbook) -> xl.Workbook:
+    # NOTE: deepcopy alone breaks IndexedList (styles, shared strings) and
+    #       TableList, whose pickle hooks rebuild them through overridden
+    #       append()/items().  Pre-seed the memo with correct copies of those.
+    #       Row/column DimensionHolders come back with their worksheet and
+    #       default_factory mixed up and are re-bound afterwards.
+    memo = {}
+    for value in vars(master).values():
+        if isinstance(value, IndexedList):
+            memo[id(value)] = IndexedList(deepcopy(list(value), memo))
+
+    for ws in master.worksheets:
+        tables = TableList()
+        for name, tbl in dict.items(ws.tables):
+            tables[name] = deepcopy(tbl, memo)
+        memo[id(ws.tables)] = tables
+
+    clone = deepcopy(master, memo)
+    for ws in clone.worksheets:
+        for holder, factory in ((ws.row_dimensions, ws._add_row),
+                                (ws.column_dimensions, ws._add_column)):
+            holder.worksheet, holder.default_factory = ws, factory
+
+    return clone
+
+
+class _Entry(NamedTuple):
+    mtime: int
+    size: int
+    digest: str
+    master: xl.Workbook
+
+
+class TemplateCache:
+
+    def __init__(self) -> None:
+        self._entries: Dict[str, _Entry] = dict()
+
+    def _load(self, path: str) -> _Entry:
+        stat = os.stat(path)
+        entry = self._entries.get(path)
+        if entry and (entry.mtime, entry.size) == (stat.st_mtime_ns, stat.st_size):
+            return entry
+
+        with open(path, 'rb') as infile:
+            raw = infile.read()
+        digest = hashlib.sha1(raw).hexdigest()
+
+        if entry and entry.digest == digest:
+            # Touched but unchanged; keep the parsed master
+            entry = entry._replace(mtime=stat.st_mtime_ns, size=stat.st_size)
+        else:
+            master = xl.load_workbook(BytesIO(clean_template(raw)))
+            entry = _Entry(stat.st_mtime_ns, stat.st_size, digest, master)
+
+        self._entries[path] = entry
+        return entry
+
+    @instrument.timed('load_template')
+    def get(self, path: str) -> xl.Workbook:
+        """Returns an independent copy of the template at `path`."""
+        return clone_workbook(self._load(path).master)
+
+    def master(self, path: str) -> xl.Workbook:
+        """The pristine parsed template; read from it, never modify it."""
+        return self._load(path).master
+
+    def digest(self, path: str) -> str:
+        return self._load(path).digest
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+TEMPLATES = TemplateCache()
+
+
+def load_template(path: str) -> xl.Workbook:
+    return TEMPLATES.get(path)
@@ -0,0 +1,258 @@
+# %%
+# Compares generated workbooks against golden copies, e.g. a known-good output
+# directory or the StateCrosstab_*_Final.xlsx files.
+#
+#   python verify.py output/state golden/state -j 0
+#   python verify.py StateCrosstab_2017_2019.xlsx StateCrosstab_2017_2019_Final.xlsx
+#
+# Each sheet is reduced to a SheetDigest: a hash of its cell values, streamed
+# with openpyxl's read-only reader, plus its merged ranges, hidden rows and
+# table refs, parsed from the sheet XML with iterparse.  Only the sheets whose
+# values differ are read again to list the differing cells.
+#
+# NOTE: Only values and structure are compared, not styles.
+
+import argparse
+import hashlib
+import os
+import posixpath
+import sys
+import zipfile
+from io import BytesIO
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, NamedTuple, Tuple
+from xml.etree import ElementTree as ET
+
+import openpyxl as xl
+from openpyxl.utils.cell import coordinate_to_tuple
+
+from parallel import JobResult, add_run_arguments, apply_run_arguments, iter_jobs
+from templates import clean_template
+
+WORKBOOK_PART = 'xl/workbook.xml'
+
+_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_REL = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_PKG = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+
+class SheetDigest(NamedTuple):
+    values: str
+    merged: Tuple[str, ...]
+    hidden_rows: Tuple[int, ...]
+    tables: Tuple[Tuple[str, str], ...]
+
+
+class Difference(NamedTuple):
+    sheet: str
+    where: str
+    generated: Any
+    golden: Any
+
+    def __str__(self) -> str:
+        where = f'{self.sheet}!{self.where}' if self.sheet else self.where
+        return f'{where}: {self.generated!r} != {self.golden!r}'
+
+
+# %% Package parts
+
+def _resolve(part: str, target: str) -> str:
+    if target.startswith('/'):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(part), target))
+
+
+def _relationships(zf: zipfile.ZipFile, part: str) -> Dict[str, str]:
+    """Relationship id -> target part of `part`."""
+    head, tail = posixpath.split(part)
+    rels = posixpath.join(head, '_rels', f'{tail}.rels')
+    if rels not in zf.namelist():
+        return dict()
+    root = ET.fromstring(zf.read(rels))
+    return {rel.get('Id'): _resolve(part, rel.get('Target'))
+            for rel in root.iter(f'{_PKG}Relationship')}
+
+
+def _sheet_parts(zf: zipfile.ZipFile) -> Dict[str, str]:
+    rels = _relationships(zf, WORKBOOK_PART)
+    root = ET.fromstring(zf.read(WORKBOOK_PART))
+    return {sheet.get('name'): rels[sheet.get(f'{_REL}id')]
+            for sheet in root.iter(f'{_MAIN}sheet')}
+
+
+def _sheet_structure(zf: zipfile.ZipFile, part: str) -> Tuple[list, list, list]:
+    """Merged ranges, hidden row numbers and (name, ref) of the tables of a sheet."""
+    merged, hidden, table_ids = [], [], []
+    rownum = 0
+    with zf.open(part) as src:
+        for _, elem in ET.iterparse(src):
+            if elem.tag == f'{_MAIN}row':
+                rownum = int(elem.get('r', rownum + 1))
+                if elem.get('hidden') in ('1', 'true'):
+                    hidden.append(rownum)
+                elem.clear()
+            elif elem.tag == f'{_MAIN}mergeCell':
+                merged.append(elem.get('ref'))
+            elif elem.tag == f'{_MAIN}tablePart':
+                table_ids.append(elem.get(f'{_REL}id'))
+
+    tables = []
+    if table_ids:
+        rels = _relationships(zf, part)
+        for rid in table_ids:
+            table = ET.fromstring(zf.read(rels[rid]))
+            tables.append((table.get('displayName') or table.get('name'), table.get('ref')))
+    return merged, hidden, tables
+
+
+# %%
+
+class WorkbookReader:
+    """Streams the cell values and sheet structure of an xlsx file."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as infile:
+            raw = clean_template(infile.read())
+        self._zip = zipfile.ZipFile(BytesIO(raw))
+        self._book = xl.load_workbook(BytesIO(raw), read_only=True)
+        self._parts = _sheet_parts(self._zip)
+
+    @property
+    def sheetnames(self) -> List[str]:
+        return self._book.sheetnames
+
+    def cells(self, sheet: str) -> Iterator[Tuple[str, Any]]:
+        """(coordinate, value) of the non-empty cells of `sheet`, by row."""
+        ws = self._book[sheet]
+        # Stored dimensions can be stale; read every row there is
+        ws.reset_dimensions()
+        for row in ws.iter_rows():
+            for cell in row:
+                if cell.value is not None:
+                    yield cell.coordinate, cell.value
+
+    def digest(self, sheet: str) -> SheetDigest:
+        sha = hashlib.sha1()
+        for item in self.cells(sheet):
+            sha.update(repr(item).encode())
+        merged, hidden, tables = _sheet_structure(self._zip, self._parts[sheet])
+        return SheetDigest(sha.hexdigest(), tuple(sorted(merged)), tuple(hidden),
+                           tuple(sorted(tables)))
+
+    def close(self):
+        self._book.close()
+        self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _cell_differences(generated: WorkbookReader, golden: WorkbookReader,
+                      sheet: str) -> List[Difference]:
+    a, b = dict(generated.cells(sheet)), dict(golden.cells(sheet))
+    return [Difference(sheet, coord, a.get(coord), b.get(coord))
+            for coord in sorted(a.keys() | b.keys(), key=coordinate_to_tuple)
+            if a.get(coord) != b.get(coord)]
+
+
+def compare_workbooks(generated: str, golden: str) -> List[Difference]:
+    """The differences of the workbook `generated` from `golden`; empty if they match."""
+    diffs = []
+    with WorkbookReader(generated) as gen, WorkbookReader(golden) as gold:
+        if gen.sheetnames != gold.sheetnames:
+            diffs.append(Difference('', 'sheets', gen.sheetnames, gold.sheetnames))
+
+        for sheet in [name for name in gen.sheetnames if name in gold.sheetnames]:
+            a, b = gen.digest(sheet), gold.digest(sheet)
+            for field in 'merged', 'hidden_rows', 'tables':
+                x, y = getattr(a, field), getattr(b, field)
+                if x != y:
+                    # Only what is missing on either side
+                    diffs.append(Difference(sheet, field, sorted(set(x) - set(y)),
+                                            sorted(set(y) - set(x))))
+            if a.values != b.values:
+                diffs.extend(_cell_differences(gen, gold, sheet))
+    return diffs
+
+
+# %% Directories
+
+class _DirPair(NamedTuple):
+    generated: str
+    golden: str
+
+
+def _compare_file(dirs: _DirPair, name: str) -> List[Difference]:
+    return compare_workbooks(os.path.join(dirs.generated, name), os.path.join(dirs.golden, name))
+
+
+def list_workbooks(path: str) -> List[str]:
+    return sorted(name for name in os.listdir(path)
+                  if name.lower().endswith(('.xlsx', '.xlsm')) and not name.startswith(('.', '~$')))
+
+
+def compare_dirs(generated: str, golden: str,
+                 jobs: int = 1) -> Tuple[Iterator[JobResult], List[str], List[str]]:
+    """
+    Compares the workbooks present in both directories on `jobs` processes.
+    Returns the results (value: the differences of each file) and the names
+    only found in `generated` or only in `golden`.
+    """
+    a, b = list_workbooks(generated), list_workbooks(golden)
+    common = [name for name in a if name in set(b)]
+    results = iter_jobs(_compare_file, common, _DirPair, (generated, golden), jobs=jobs)
+    return results, sorted(set(a) - set(b)), sorted(set(b) - set(a))
+
+
+def print_differences(name: str, diffs: List[Difference], limit: int = None):
+    print(f'{name}: {len(diffs)} difference{"s" * (len(diffs) != 1)}')
+    for diff in diffs[:limit or None]:
+        print(f'  {diff}')
+    if limit and len(diffs) > limit:
+        print(f'  ... and {len(diffs) - limit} more')
+
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare generated workbooks with golden copies')
+    parser.add_argument('generated', help='workbook or directory of workbooks')
+    parser.add_argument('golden', help='workbook or directory of workbooks')
+    parser.add_argument('--max-cells', type=int, default=20,
+                        help='differences listed per workbook (0 = all)')
+    add_run_arguments(parser)
+    args = parser.parse_args()
+    apply_run_arguments(args)
+
+    start = perf_counter()
+    if os.path.isfile(args.generated):
+        diffs = compare_workbooks(args.generated, args.golden)
+        if diffs:
+            print_differences(os.path.basename(args.generated), diffs, args.max_cells)
+        print(f'{"differs" if diffs else "matches"} ({perf_counter()-start:.2f}s)')
+        sys.exit(1 if diffs else 0)
+
+    results, only_generated, only_golden = compare_dirs(args.generated, args.golden, args.jobs)
+    compared, differ, failed = 0, 0, 0
+    for result in results:
+        compared += 1
+        if not result.ok:
+            failed += 1
+            print(f'{result.key}: FAILED\n{result.error}')
+        elif result.value:
+            differ += 1
+            print_differences(result.key, result.value, args.max_cells)
+    for name in only_generated:
+        print(f'{name}: no golden copy')
+    for name in only_golden:
+        print(f'{name}: not generated')
+
+    print(f'{compared} compared, {differ} differ, {failed} failed, '
+          f'{len(only_generated) + len(only_golden)} unmatched ({perf_counter()-start:.2f}s)')
+    sys.exit(1 if differ or failed or only_generated or only_golden else 0)
+
+# %%
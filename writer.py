@@ -0,0 +1,156 @@
+# %%
+# Saving an xlsx (serializing every sheet and deflating the zip) takes about as
+# long as filling it.  A BackgroundWriter takes finished workbooks, or their
+# already-serialized bytes, and writes them out on a thread or process pool so
+# the generator can move on to the next table.
+#
+# NOTE: The thread backend overlaps the zlib/disk work, which releases the GIL.
+#       The process backend also moves openpyxl's XML serialization off the
+#       generator, at the cost of pickling each workbook over to the writer.
+
+import pickle
+import threading
+import traceback
+from argparse import ArgumentParser
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from time import perf_counter
+from typing import List, Union
+
+import openpyxl as xl
+from openpyxl.utils.indexed_list import IndexedList
+from openpyxl.worksheet.dimensions import DimensionHolder
+from openpyxl.worksheet.table import TableList
+
+from parallel import JobResult
+
+BACKENDS = ('thread', 'process')
+
+
+# %%
+# Pickling workbooks.  Like deepcopy (see templates.clone_workbook), the default
+# pickle hooks rebuild IndexedList and TableList through their overridden
+# append()/items() and mix up the worksheet and default_factory of the row and
+# column dimensions.
+
+def _table_list(tables: dict) -> TableList:
+    out = TableList()
+    out.update(tables)
+    return out
+
+
+def _dimension_holder(worksheet, reference: str, factory: str, items: dict) -> DimensionHolder:
+    holder = DimensionHolder(worksheet, reference,
+                             getattr(worksheet, factory) if factory else None)
+    holder.update(items)
+    return holder
+
+
+class WorkbookPickler(pickle.Pickler):
+
+    def reducer_override(self, obj):
+        if isinstance(obj, IndexedList):
+            return IndexedList, (list(obj),)
+        if isinstance(obj, TableList):
+            return _table_list, (dict(dict.items(obj)),)
+        if isinstance(obj, DimensionHolder):
+            factory = getattr(obj.default_factory, '__name__', None)
+            return _dimension_holder, (obj.worksheet, obj.reference, factory, dict(obj))
+        return NotImplemented
+
+
+def dumps_workbook(wb: xl.Workbook) -> bytes:
+    buf = BytesIO()
+    WorkbookPickler(buf, pickle.HIGHEST_PROTOCOL).dump(wb)
+    return buf.getvalue()
+
+
+def save_bytes(data: bytes, path: str):
+    with open(path, 'wb') as outfile:
+        outfile.write(data)
+
+
+def _save_pickled(data: bytes, path: str):
+    pickle.loads(data).save(path)
+
+
+def _save(fn, payload, path: str) -> JobResult:
+    start = perf_counter()
+    try:
+        fn(payload, path)
+        return JobResult(path, True, perf_counter()-start)
+    except Exception:
+        return JobResult(path, False, perf_counter()-start, traceback.format_exc())
+
+
+# %%
+
+class BackgroundWriter:
+    """
+    Writes workbooks on `workers` threads or processes.  At most `max_pending`
+    saves are queued or running; submit() blocks until a slot frees up, which
+    keeps the number of finished workbooks held in memory bounded.
+    """
+
+    def __init__(self, backend: str = 'thread', workers: int = 1, max_pending: int = None) -> None:
+        if backend not in BACKENDS:
+            raise ValueError(f'unknown writer backend: {backend}')
+        self.backend = backend
+        pool = ThreadPoolExecutor if backend == 'thread' else ProcessPoolExecutor
+        self._pool = pool(workers)
+        self._slots = threading.BoundedSemaphore(max_pending or 2*workers)
+        self._futures: List[Future] = []
+        self._reported = 0
+
+    def submit(self, wb: Union[xl.Workbook, bytes], path: str) -> Future:
+        """Queues `wb` (a workbook or a serialized xlsx) to be written to `path`."""
+        if isinstance(wb, bytes):
+            fn, payload = save_bytes, wb
+        elif self.backend == 'process':
+            fn, payload = _save_pickled, dumps_workbook(wb)
+        else:
+            fn, payload = xl.Workbook.save, wb
+
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(_save, fn, payload, path)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        return future
+
+    def done(self) -> List[JobResult]:
+        """Results of the saves finished in submission order since the last call."""
+        results = []
+        while self._reported < len(self._futures) and self._futures[self._reported].done():
+            results.append(self._futures[self._reported].result())
+            self._reported += 1
+        return results
+
+    def close(self) -> List[JobResult]:
+        """Waits for the queued saves and returns the results not yet reported."""
+        self._pool.shutdown(wait=True)
+        return self.done()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def add_writer_arguments(parser: ArgumentParser):
+    parser.add_argument('--writer', choices=BACKENDS,
+                        help='save workbooks in the background on a thread or process '
+                             '(in-process runs only, i.e. --jobs 1)')
+
+
+def get_writer(args):
+    """The background writer asked for on the command line, or None."""
+    if args.writer and args.jobs == 1:
+        return BackgroundWriter(args.writer)
+    return None
+